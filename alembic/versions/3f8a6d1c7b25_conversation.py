@@ -0,0 +1,77 @@
+"""conversation
+
+Revision ID: 3f8a6d1c7b25
+Revises: 7b1f3c9d2e64
+Create Date: 2026-10-18 17:26:44.091357
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f8a6d1c7b25'
+down_revision: Union[str, None] = '7b1f3c9d2e64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('peer_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('last_posted', sa.DateTime(), nullable=True),
+    sa.Column('unread_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('message_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('read_count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['peer_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ux_conversation_user_peer', 'conversation', ['user_id', 'peer_id'], unique=True,
+        postgresql_where=sa.text('peer_id IS NOT NULL'),
+    )
+    op.create_index(
+        'ux_conversation_user_public', 'conversation', ['user_id'], unique=True,
+        postgresql_where=sa.text('user_id IS NOT NULL AND peer_id IS NULL'),
+    )
+    op.create_index(
+        'ux_conversation_public', 'conversation', [sa.text('(user_id IS NULL)')], unique=True,
+        postgresql_where=sa.text('user_id IS NULL'),
+    )
+
+    # Existing history counts as read, only messages from now on are unread
+    op.execute('''
+        INSERT INTO conversation (user_id, peer_id, last_message_id, last_posted, message_count)
+        SELECT NULL, NULL, max(id), max(posted), count(*) FROM message WHERE receiver_id IS NULL
+    ''')
+    op.execute('''
+        INSERT INTO conversation (user_id, peer_id, read_count)
+        SELECT "user".id, NULL, public.message_count
+        FROM "user" CROSS JOIN (SELECT message_count FROM conversation WHERE user_id IS NULL) AS public
+    ''')
+    op.execute('''
+        INSERT INTO conversation (user_id, peer_id, last_message_id, last_posted)
+        SELECT DISTINCT ON (user_id, peer_id) user_id, peer_id, id, posted
+        FROM (
+            SELECT sender_id AS user_id, receiver_id AS peer_id, id, posted
+            FROM message WHERE receiver_id IS NOT NULL
+            UNION ALL
+            SELECT receiver_id, sender_id, id, posted
+            FROM message WHERE receiver_id IS NOT NULL AND sender_id IS DISTINCT FROM receiver_id
+        ) AS sides
+        WHERE user_id IS NOT NULL AND peer_id IS NOT NULL
+        ORDER BY user_id, peer_id, id DESC
+    ''')
+
+
+def downgrade() -> None:
+    op.drop_index('ux_conversation_public', table_name='conversation')
+    op.drop_index('ux_conversation_user_public', table_name='conversation')
+    op.drop_index('ux_conversation_user_peer', table_name='conversation')
+    op.drop_table('conversation')
@@ -0,0 +1,33 @@
+"""message chat indexes
+
+Revision ID: 5a7e2c91d4f3
+Revises: c88802de8e3c
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a7e2c91d4f3'
+down_revision: Union[str, None] = 'c88802de8e3c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_message_sender_id_posted', 'message', ['sender_id', 'posted', 'id'], unique=False)
+    op.create_index('ix_message_receiver_id_posted', 'message', ['receiver_id', 'posted', 'id'], unique=False)
+    op.create_index(
+        'ix_message_public_posted', 'message', ['posted', 'id'], unique=False,
+        postgresql_where=sa.text('receiver_id IS NULL'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_message_public_posted', table_name='message')
+    op.drop_index('ix_message_receiver_id_posted', table_name='message')
+    op.drop_index('ix_message_sender_id_posted', table_name='message')
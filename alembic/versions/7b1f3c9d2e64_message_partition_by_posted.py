@@ -0,0 +1,104 @@
+"""message partition by posted
+
+Revision ID: 7b1f3c9d2e64
+Revises: e4c1a7b25f90
+Create Date: 2026-10-18 15:02:17.480931
+
+"""
+from datetime import date, datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b1f3c9d2e64'
+down_revision: Union[str, None] = 'e4c1a7b25f90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MONTHS_AHEAD = 3
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def create_indexes() -> None:
+    op.create_index('ix_message_id', 'message', ['id'], unique=False)
+    op.create_index('ix_message_sender_id_posted', 'message', ['sender_id', 'posted', 'id'], unique=False)
+    op.create_index('ix_message_receiver_id_posted', 'message', ['receiver_id', 'posted', 'id'], unique=False)
+    op.create_index(
+        'ix_message_public_posted', 'message', ['posted', 'id'], unique=False,
+        postgresql_where=sa.text('receiver_id IS NULL'),
+    )
+
+
+def rename_indexes(suffix: str) -> None:
+    for name in ('ix_message_public_posted', 'ix_message_receiver_id_posted', 'ix_message_sender_id_posted',
+                 'ix_message_id'):
+        op.execute(f'ALTER INDEX {name} RENAME TO {name}_{suffix}')
+
+
+def upgrade() -> None:
+    op.execute('ALTER TABLE message RENAME TO message_old')
+    op.execute('ALTER TABLE message_old RENAME CONSTRAINT message_pkey TO message_old_pkey')
+    rename_indexes('old')
+
+    # The partition key has to be part of the primary key, ids stay unique through the sequence
+    op.execute('''
+        CREATE TABLE message (
+            id INTEGER NOT NULL DEFAULT nextval('message_id_seq'),
+            text VARCHAR,
+            sender_id INTEGER REFERENCES "user" (id),
+            receiver_id INTEGER REFERENCES "user" (id),
+            posted TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (id, posted)
+        ) PARTITION BY RANGE (posted)
+    ''')
+
+    first_posted = op.get_bind().execute(sa.text('SELECT min(posted) FROM message_old')).scalar()
+    today = datetime.utcnow().date().replace(day=1)
+    month = min(first_posted.date(), today).replace(day=1) if first_posted else today
+    last = today
+    for _ in range(MONTHS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        op.execute(
+            f"CREATE TABLE message_p{month:%Y_%m} PARTITION OF message "
+            f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"
+        )
+        month = next_month(month)
+
+    op.execute('''
+        INSERT INTO message (id, text, sender_id, receiver_id, posted)
+        SELECT id, text, sender_id, receiver_id, coalesce(posted, now()) FROM message_old
+    ''')
+    op.execute('ALTER SEQUENCE message_id_seq OWNED BY message.id')
+    op.execute('DROP TABLE message_old')
+    create_indexes()
+
+
+def downgrade() -> None:
+    # Partitions already archived by chat.partitions are not restored
+    op.execute('ALTER TABLE message RENAME TO message_partitioned')
+    op.execute('ALTER TABLE message_partitioned RENAME CONSTRAINT message_pkey TO message_partitioned_pkey')
+    rename_indexes('partitioned')
+    op.execute('''
+        CREATE TABLE message (
+            id INTEGER NOT NULL DEFAULT nextval('message_id_seq'),
+            text VARCHAR,
+            sender_id INTEGER REFERENCES "user" (id),
+            receiver_id INTEGER REFERENCES "user" (id),
+            posted TIMESTAMP WITHOUT TIME ZONE,
+            CONSTRAINT message_pkey PRIMARY KEY (id)
+        )
+    ''')
+    op.execute('''
+        INSERT INTO message (id, text, sender_id, receiver_id, posted)
+        SELECT id, text, sender_id, receiver_id, posted FROM message_partitioned
+    ''')
+    op.execute('ALTER SEQUENCE message_id_seq OWNED BY message.id')
+    op.execute('DROP TABLE message_partitioned')
+    create_indexes()
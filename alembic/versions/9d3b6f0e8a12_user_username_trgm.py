@@ -0,0 +1,30 @@
+"""user username trgm
+
+Revision ID: 9d3b6f0e8a12
+Revises: 5a7e2c91d4f3
+Create Date: 2026-10-18 12:40:07.562913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d3b6f0e8a12'
+down_revision: Union[str, None] = '5a7e2c91d4f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index(
+        'ix_user_username_trgm', 'user', ['username'], unique=False,
+        postgresql_using='gin',
+        postgresql_ops={'username': 'gin_trgm_ops'},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_username_trgm', table_name='user')
@@ -0,0 +1,53 @@
+"""conversation public shards
+
+Revision ID: a62d0e4f9c18
+Revises: 3f8a6d1c7b25
+Create Date: 2026-10-18 21:04:12.518306
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a62d0e4f9c18'
+down_revision: Union[str, None] = '3f8a6d1c7b25'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('conversation', sa.Column('shard', sa.Integer(), nullable=True))
+    op.execute('UPDATE conversation SET shard = 0 WHERE user_id IS NULL')
+    op.drop_index('ux_conversation_public', table_name='conversation')
+    op.create_index(
+        'ux_conversation_public_shard', 'conversation', ['shard'], unique=True,
+        postgresql_where=sa.text('user_id IS NULL'),
+    )
+
+
+def downgrade() -> None:
+    op.execute('''
+        UPDATE conversation SET
+            message_count = total.message_count,
+            last_message_id = total.last_message_id,
+            last_posted = total.last_posted
+        FROM (
+            SELECT min(shard) AS shard, sum(message_count) AS message_count,
+                max(last_message_id) AS last_message_id, max(last_posted) AS last_posted
+            FROM conversation WHERE user_id IS NULL
+        ) AS total
+        WHERE conversation.user_id IS NULL AND conversation.shard = total.shard
+    ''')
+    op.execute('''
+        DELETE FROM conversation
+        WHERE user_id IS NULL AND shard > (SELECT min(shard) FROM conversation WHERE user_id IS NULL)
+    ''')
+    op.drop_index('ux_conversation_public_shard', table_name='conversation')
+    op.create_index(
+        'ux_conversation_public', 'conversation', [sa.text('(user_id IS NULL)')], unique=True,
+        postgresql_where=sa.text('user_id IS NULL'),
+    )
+    op.drop_column('conversation', 'shard')
@@ -0,0 +1,32 @@
+"""message default partition
+
+Revision ID: d8e2b6a4c315
+Revises: a62d0e4f9c18
+Create Date: 2026-10-18 21:47:35.204117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8e2b6a4c315'
+down_revision: Union[str, None] = 'a62d0e4f9c18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Inserts past the last monthly partition land here until chat.partitions create moves them out
+    op.execute('CREATE TABLE message_default PARTITION OF message DEFAULT')
+
+
+def downgrade() -> None:
+    waiting = op.get_bind().execute(sa.text('SELECT count(*) FROM message_default')).scalar()
+    if waiting:
+        raise RuntimeError(
+            f'message_default still holds {waiting} messages, run python -m chat.partitions create first'
+        )
+    op.execute('DROP TABLE message_default')
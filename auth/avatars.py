@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import anyio
+from fastapi import HTTPException, Request, Response, status
+from starlette.types import Receive, Scope, Send
+
+from auth import schema
+from auth.models import User
+from auth.utils import get_upload_path
+from config import settings
+from database import async_session_maker
+
+logger = logging.getLogger(__name__)
+
+avatar_executor = ProcessPoolExecutor(max_workers=settings.avatar_workers)
+
+AVATAR_FILE_NAME = re.compile(r"[0-9a-f]{64}(_[0-9]+)?\.(jpg|png)")
+AVATAR_MEDIA_TYPES = {"jpg": "image/jpeg", "png": "image/png"}
+AVATAR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def render_avatar_variants(source_path: str, sizes: list[int]) -> dict[str, str]:
+    # Runs in a worker process, Pillow is only needed there
+    from PIL import Image, ImageOps
+
+    digest, extension = os.path.splitext(os.path.basename(source_path))
+    variants = {}
+    with Image.open(source_path) as image:
+        image.load()
+        if image.format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        for size in sizes:
+            full_path = get_upload_path(f"{digest}_{size}{extension}")
+            if not os.path.exists(full_path):
+                variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+                tmp_path = f"{full_path}.part"
+                if extension == ".jpg":
+                    variant.save(tmp_path, "JPEG", quality=85, optimize=True, progressive=True)
+                else:
+                    variant.save(tmp_path, "PNG", optimize=True)
+                os.replace(tmp_path, full_path)
+            variants[str(size)] = full_path
+    return variants
+
+
+def avatar_url(request: Request, avatar_path: str | None) -> str | None:
+    # Stored paths stay internal, clients get the route that serves the file
+    if avatar_path is None:
+        return None
+    return str(request.url_for("get_avatar", file_name=os.path.basename(avatar_path)))
+
+
+def pick_avatar_variant(
+        request: Request,
+        avatar_link: str | None,
+        avatar_variants: dict[str, str] | None,
+        size: int | None,
+) -> str | None:
+    if avatar_link is None:
+        return None
+    if not size or not avatar_variants:
+        return avatar_url(request, avatar_link)
+    sizes = sorted(int(variant_size) for variant_size in avatar_variants)
+    best = next((variant_size for variant_size in sizes if variant_size >= size), sizes[-1])
+    return avatar_url(request, avatar_variants[str(best)])
+
+
+def user_with_avatar_urls(request: Request, user: User, size: int | None = None) -> schema.UserFromDB:
+    user = schema.UserFromDB.model_validate(user, from_attributes=True)
+    user.avatar_link = pick_avatar_variant(request, user.avatar_link, user.avatar_variants, size)
+    if user.avatar_variants:
+        user.avatar_variants = {
+            variant_size: avatar_url(request, path) for variant_size, path in user.avatar_variants.items()
+        }
+    return user
+
+
+async def process_avatar(user_id: int, avatar_path: str):
+    loop = asyncio.get_running_loop()
+    try:
+        variants = await loop.run_in_executor(
+            avatar_executor, render_avatar_variants, avatar_path, settings.avatar_sizes
+        )
+    except Exception:
+        logger.exception("Failed to render avatar variants for %s", avatar_path)
+        return
+    async with async_session_maker() as session:
+        user = await User.get_by_id(session, user_id)
+        # Skip stale results when another avatar was uploaded in the meantime
+        if user is not None and user.avatar_link == avatar_path:
+            await user.add_avatar_variants(session, variants)
+
+
+class AvatarFileResponse(Response):
+    """Sends a byte range of a stored avatar, zero-copy when the server supports it."""
+    chunk_size = 64 * 1024
+
+    def __init__(
+            self,
+            path: str,
+            offset: int,
+            length: int,
+            status_code: int,
+            headers: dict[str, str],
+            media_type: str,
+            send_header_only: bool = False,
+    ):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.status_code = status_code
+        self.media_type = media_type
+        self.send_header_only = send_header_only
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only or not self.length:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            file = await anyio.to_thread.run_sync(open, self.path, "rb")
+            try:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file,
+                    "offset": self.offset,
+                    "count": self.length,
+                    "more_body": False,
+                })
+            finally:
+                await anyio.to_thread.run_sync(file.close)
+            return
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    start, _, end = ranges.strip().partition("-")
+    try:
+        if not start:
+            first = size - min(int(end), size)
+            last = size - 1
+        else:
+            first = int(start)
+            last = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if first > last:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"content-range": f"bytes */{size}"},
+        )
+    return first, last - first + 1
+
+
+def build_avatar_response(request: Request, file_name: str, size: int) -> Response:
+    etag = f'"{file_name.rsplit(".", 1)[0]}"'
+    headers = {
+        "etag": etag,
+        "cache-control": AVATAR_CACHE_CONTROL,
+        "accept-ranges": "bytes",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    ]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    offset, length, status_code = 0, size, status.HTTP_200_OK
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+        if byte_range is not None:
+            offset, length = byte_range
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers["content-range"] = f"bytes {offset}-{offset + length - 1}/{size}"
+
+    return AvatarFileResponse(
+        get_upload_path(file_name),
+        offset=offset,
+        length=length,
+        status_code=status_code,
+        headers=headers,
+        media_type=AVATAR_MEDIA_TYPES[file_name.rsplit(".", 1)[1]],
+        send_header_only=request.method == "HEAD",
+    )
@@ -1,9 +1,9 @@
-from sqlalchemy import Column, Integer, String, select
+from sqlalchemy import Column, Integer, String, JSON, Index, case, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship
 
 from auth import schema
-from auth.utils import get_password_hash
+from auth.utils import get_password_hash_async, user_cache, username_cache
 from database import Base
 
 
@@ -14,12 +14,21 @@ class User(Base):
     username = Column(String, unique=True)
     hash_password = Column(String)
     avatar_link = Column(String)
+    avatar_variants = Column(JSON)
     phone_number = Column(String)
     etc = Column(String)
 
     messages = relationship("Message", back_populates="sender", foreign_keys='Message.sender_id')
     private_messages = relationship("Message", back_populates="receiver", foreign_keys='Message.receiver_id')
 
+    __table_args__ = (
+        Index(
+            'ix_user_username_trgm', 'username',
+            postgresql_using='gin',
+            postgresql_ops={'username': 'gin_trgm_ops'},
+        ),
+    )
+
     @classmethod
     async def get_by_username(
             cls,
@@ -50,13 +59,20 @@ class User(Base):
             username=user.username,
             phone_number=user.phone_number,
             etc=user.etc,
-            hash_password=get_password_hash(user.password)
+            hash_password=await get_password_hash_async(user.password)
         )
         user_from_db = await cls.get_by_username(session, user.username)
         if not user_from_db:
+            # chat.models maps Message against this module
+            from chat.models import Conversation
+
             user = cls(**user.__dict__)
             session.add(user)
+            await session.flush()
+            # Public messages from before signup don't count as unread
+            await Conversation.catch_up_public(session, [user.id])
             await session.commit()
+            username_cache.invalidate(user.username)
             await session.refresh(user)
             return user
         else:
@@ -67,21 +83,35 @@ class User(Base):
             cls,
             session: AsyncSession,
             query: str,
+            limit: int,
+            offset: int = 0,
     ):
-        db_query = select(cls).filter(cls.username.ilike(f"%{query}%"))
+        pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        rank = case(
+            (func.lower(cls.username) == query.lower(), 0),
+            (cls.username.ilike(f"{pattern}%", escape='\\'), 1),
+            else_=2,
+        )
+        db_query = select(cls.id, cls.username, cls.avatar_link, cls.avatar_variants).filter(
+            cls.username.ilike(f"%{pattern}%", escape='\\')
+        ).order_by(rank, func.length(cls.username), cls.username).limit(limit).offset(offset)
         result = await session.execute(db_query)
-        return result.scalars().all()
+        return result.all()
 
     async def update(
             self,
             session: AsyncSession,
             user_to_update: schema.UserToUpdate,
     ):
+        old_username = self.username
         for key, value in user_to_update.__dict__.items():
             if value:
                 setattr(self, key, value)
         session.add(self)
         await session.commit()
+        user_cache.invalidate(self.id)
+        username_cache.invalidate(old_username)
+        username_cache.invalidate(self.username)
         await session.refresh(self)
         return self
 
@@ -91,6 +121,19 @@ class User(Base):
             avatar_link: str,
     ):
         self.avatar_link = avatar_link
+        self.avatar_variants = None
+        await session.commit()
+        user_cache.invalidate(self.id)
+        await session.refresh(self)
+        return self
+
+    async def add_avatar_variants(
+            self,
+            session: AsyncSession,
+            avatar_variants: dict[str, str],
+    ):
+        self.avatar_variants = avatar_variants
         await session.commit()
+        user_cache.invalidate(self.id)
         await session.refresh(self)
         return self
@@ -0,0 +1,160 @@
+"""Bulk user import from CSV or NDJSON, also usable from the command line:
+
+    python -m auth.provisioning users.csv > results.ndjson
+
+Rows are read, hashed and inserted in fixed-size batches, so memory does not
+depend on the size of the input. Each row produces one result line.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import AsyncIterator, Iterator, TextIO
+
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from auth import schema
+from auth.models import User
+from auth.utils import get_password_hash, username_cache
+from chat.models import Conversation
+from config import settings
+from database import async_session_maker, dialect_insert
+
+provisioning_executor = ProcessPoolExecutor(max_workers=settings.bulk_import_workers)
+
+IMPORT_FIELDS = ('username', 'password', 'phone_number', 'etc')
+
+
+def get_password_hashes(passwords: list[str]) -> list[str]:
+    return [get_password_hash(password) for password in passwords]
+
+
+def read_rows(text_file: TextIO, file_format: str) -> Iterator[tuple[int, dict | None]]:
+    """(line number, row) pairs, row is None when the line can't be parsed."""
+    if file_format == 'csv':
+        reader = csv.DictReader(text_file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(text_file, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+async def read_batches(rows: Iterator[tuple[int, dict | None]], size: int) -> AsyncIterator[list]:
+    # The file is read in a thread, one batch at a time
+    while batch := await run_in_threadpool(lambda: list(islice(rows, size))):
+        yield batch
+
+
+def insert_ignoring_existing(session: AsyncSession):
+    return dialect_insert(session, User).on_conflict_do_nothing(index_elements=['username'])
+
+
+async def hash_passwords(passwords: list[str]) -> list[str]:
+    loop = asyncio.get_running_loop()
+    chunk_size = -(-len(passwords) // settings.bulk_import_workers)
+    chunks = [passwords[start:start + chunk_size] for start in range(0, len(passwords), chunk_size)]
+    hashed = await asyncio.gather(*[
+        loop.run_in_executor(provisioning_executor, get_password_hashes, chunk) for chunk in chunks
+    ])
+    return [password_hash for chunk in hashed for password_hash in chunk]
+
+
+async def provision_batch(session: AsyncSession, batch: list[tuple[int, dict | None]]) -> list[dict]:
+    results: list[dict | None] = [None] * len(batch)
+    users: dict[int, schema.NewUser] = {}
+    for index, (line, row) in enumerate(batch):
+        if row is None:
+            results[index] = {'line': line, 'status': 'invalid', 'error': 'unreadable row'}
+            continue
+        try:
+            users[index] = schema.NewUser.parse_obj({key: row.get(key) or None for key in IMPORT_FIELDS})
+        except ValidationError as err:
+            error = '; '.join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in err.errors())
+            results[index] = {'line': line, 'status': 'invalid', 'error': error}
+
+    # Known usernames are skipped before paying for their hashes
+    existing = set((await session.scalars(
+        select(User.username).filter(User.username.in_([user.username for user in users.values()]))
+    )).all()) if users else set()
+    new_users = {index: user for index, user in users.items() if user.username not in existing}
+
+    created = {}
+    if new_users:
+        hashes = await hash_passwords([user.password for user in new_users.values()])
+        rows = [
+            schema.UserForDB(
+                username=user.username,
+                phone_number=user.phone_number,
+                etc=user.etc,
+                hash_password=password_hash,
+            ).dict()
+            for user, password_hash in zip(new_users.values(), hashes)
+        ]
+        result = await session.execute(insert_ignoring_existing(session).values(rows).returning(User.id, User.username))
+        created = {username: user_id for user_id, username in result.all()}
+        if created:
+            # Public messages from before signup don't count as unread
+            await Conversation.catch_up_public(session, sorted(created.values()))
+        await session.commit()
+        for username in created:
+            username_cache.invalidate(username)
+
+    for index, user in users.items():
+        line = batch[index][0]
+        user_id = created.pop(user.username, None) if index in new_users else None
+        if user_id is not None:
+            results[index] = {'line': line, 'username': user.username, 'status': 'created', 'id': user_id}
+        else:
+            results[index] = {'line': line, 'username': user.username, 'status': 'skipped'}
+    return results
+
+
+async def provision_users(text_file: TextIO, file_format: str) -> AsyncIterator[dict]:
+    rows = read_rows(text_file, file_format)
+    async with async_session_maker() as session:
+        async for batch in read_batches(rows, settings.bulk_import_batch_size):
+            for result in await provision_batch(session, batch):
+                yield result
+
+
+def detect_format(file_name: str | None, content_type: str | None = None) -> str:
+    if (file_name or '').lower().endswith('.csv') or content_type == 'text/csv':
+        return 'csv'
+    return 'ndjson'
+
+
+async def run(args):
+    from database import engine
+
+    with open(args.file, encoding='utf-8', newline='') as text_file:
+        async for result in provision_users(text_file, args.format or detect_format(args.file)):
+            sys.stdout.write(json.dumps(result, ensure_ascii=False) + '\n')
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help='CSV with a header row or NDJSON, fields: ' + ', '.join(IMPORT_FIELDS))
+    parser.add_argument('--format', choices=('csv', 'ndjson'))
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    finally:
+        provisioning_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
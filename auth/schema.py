@@ -32,7 +32,18 @@ class UserInDB(UserForDB):
 
 
 class UserFromDB(UserInDB):
-    avatar_link: str
+    avatar_link: Union[str, None] = None
+    avatar_variants: Union[dict[str, str], None] = None
+
+
+class PublicUser(BaseModel):
+    id: int
+    username: str
+    avatar_link: Union[str, None] = None
+
+
+class UsersSearch(BaseModel):
+    users: list[PublicUser]
 
 
 class UserToUpdate(BaseModel):
@@ -1,22 +1,49 @@
+import asyncio
+import hashlib
 import os
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Annotated
+from typing import Annotated, BinaryIO
 
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status, UploadFile
 from passlib.context import CryptContext
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from auth import schema
 from auth import models
 
+from cache import AsyncTTLCache
 from database import get_async_session
 from config import settings
+from metrics import registry
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+AVATAR_MAX_SIZE = 2 * 1024 * 1024  # 2 MB
+AVATAR_MAX_BODY_SIZE = AVATAR_MAX_SIZE + UPLOAD_CHUNK_SIZE  # room for the multipart boundary and part headers
+AVATAR_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png"}
+
+user_cache = AsyncTTLCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl)
+username_cache = AsyncTTLCache(
+    maxsize=settings.username_cache_size,
+    ttl=settings.username_cache_ttl,
+    negative_ttl=settings.username_cache_negative_ttl,
+)
+registry.counter_callback('user_cache_hits_total', 'User cache hits.', lambda: user_cache.hits)
+registry.counter_callback('user_cache_misses_total', 'User cache misses.', lambda: user_cache.misses)
+registry.counter_callback('username_cache_hits_total', 'Username cache hits.', lambda: username_cache.hits)
+registry.counter_callback('username_cache_misses_total', 'Username cache misses.', lambda: username_cache.misses)
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -26,11 +53,40 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+def create_password_hash_executor() -> Executor:
+    if settings.password_hash_executor == 'process':
+        return ProcessPoolExecutor(max_workers=settings.password_hash_workers)
+    return ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix='password-hash')
+
+
+password_hash_executor = create_password_hash_executor()
+password_hash_slots = asyncio.Semaphore(settings.password_hash_workers + settings.password_hash_queue_size)
+
+
+async def run_password_hashing(func, *args):
+    if password_hash_slots.locked():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, try again later",
+            headers={"Retry-After": "1"},
+        )
+    async with password_hash_slots:
+        return await asyncio.get_running_loop().run_in_executor(password_hash_executor, func, *args)
+
+
+async def verify_password_async(plain_password, hashed_password):
+    return await run_password_hashing(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password):
+    return await run_password_hashing(get_password_hash, password)
+
+
 async def authenticate_user(session: AsyncSession, username: str, password: str):
     user: schema.UserInDB = await models.User.get_by_username(session, username)
     if not user:
         return False
-    if not verify_password(password, user.hash_password):
+    if not await verify_password_async(password, user.hash_password):
         return False
     return user
 
@@ -46,6 +102,13 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
+async def load_detached_user(session: AsyncSession, user_id: int):
+    user = await models.User.get_by_id(session, user_id=user_id)
+    if user is not None:
+        session.expunge(user)
+    return user
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
                            session: AsyncSession = Depends(get_async_session)):
     credentials_exception = HTTPException(
@@ -62,28 +125,99 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
     except JWTError as err:
         print(err)
         raise credentials_exception
-    user = await models.User.get_by_id(session, user_id=token_data.user_id)
+    expires_in = payload["exp"] - time.time() if payload.get("exp") else None
+    user = await user_cache.get_or_load(
+        token_data.user_id,
+        lambda: load_detached_user(session, token_data.user_id),
+        ttl=expires_in,
+    )
     if user is None:
         raise credentials_exception
-    return user
+    # The cached row stays detached, every request works on its own copy
+    return await session.merge(user, load=False)
+
+
+def get_upload_path(file_name: str) -> str:
+    return os.path.join(settings.upload_file_path, file_name[:2], file_name)
+
+
+def write_upload_chunk(uploaded_file: BinaryIO, digest, chunk: bytes):
+    digest.update(chunk)
+    uploaded_file.write(chunk)
 
 
-async def save_file_to_uploads(file: UploadFile, user_id: int):
-    directory = os.path.join(settings.upload_file_path, str(user_id))
-    if not os.path.exists(directory):
-        os.mkdir(directory)
-    full_path = os.path.join(directory, file.filename)
-    with open(full_path, "wb") as uploaded_file:
-        file_content = await file.read()
-        uploaded_file.write(file_content)
+def store_upload(tmp_path: str, file_name: str) -> str:
+    full_path = get_upload_path(file_name)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    if os.path.exists(full_path):
+        # Same content is already stored, keep the existing file
+        os.remove(tmp_path)
+    else:
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, full_path)
     return full_path
 
 
+def create_upload_tmp() -> tuple[int, str]:
+    os.makedirs(settings.upload_file_path, exist_ok=True)
+    return tempfile.mkstemp(dir=settings.upload_file_path, suffix='.part')
+
+
+async def save_file_to_uploads(file: UploadFile):
+    fd, tmp_path = await run_in_threadpool(create_upload_tmp)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as uploaded_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > AVATAR_MAX_SIZE:
+                    raise HTTPException(status_code=400, detail="File size exceeds 2 MB")
+                await run_in_threadpool(write_upload_chunk, uploaded_file, digest, chunk)
+        file_name = f"{digest.hexdigest()}.{AVATAR_EXTENSIONS[file.content_type]}"
+        return await run_in_threadpool(store_upload, tmp_path, file_name)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class BodySizeLimitMiddleware:
+    """Rejects request bodies over a per-path limit while they arrive, before the form parser spools them."""
+
+    def __init__(self, app: ASGIApp, limits: dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limit = self.limits.get(scope['path']) if scope['type'] == 'http' else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        content_length = Headers(scope=scope).get('content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse({'detail': "File size exceeds 2 MB"}, status_code=status.HTTP_400_BAD_REQUEST)
+            await response(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    # Chunked bodies have no Content-Length, stop reading once they run over
+                    raise HTTPException(status_code=400, detail="File size exceeds 2 MB")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
 def validate_file(file: UploadFile):
-    allowed_types = ["image/jpeg", "image/png"]
-    if file.content_type not in allowed_types:
+    if file.content_type not in AVATAR_EXTENSIONS:
         raise HTTPException(status_code=400, detail="Only JPEG and PNG files allowed")
-    max_size = 2 * 1024 * 1024  # 2 MB
-    if file.size > max_size:
+    # The size is enforced again while the upload is streamed to disk
+    if file.size is not None and file.size > AVATAR_MAX_SIZE:
         raise HTTPException(status_code=400, detail="File size exceeds 2 MB")
     return file
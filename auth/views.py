@@ -1,14 +1,23 @@
+import io
+import json
 import os
+import secrets
 from typing import Annotated
 from datetime import timedelta
-from fastapi import APIRouter, Depends, Body, HTTPException, UploadFile, Query, Response
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, UploadFile, Query, Request, \
+    Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 from starlette import status
 
 from auth import schema
 from auth.models import User
+from auth.avatars import AVATAR_FILE_NAME, build_avatar_response, pick_avatar_variant, process_avatar, \
+    user_with_avatar_urls
+from auth.provisioning import detect_format, provision_users
 from auth.utils import authenticate_user, create_access_token, get_current_user, \
-    save_file_to_uploads, validate_file
+    get_upload_path, save_file_to_uploads, validate_file
 from config import settings
 from database import get_async_session
 
@@ -43,9 +52,11 @@ async def login_for_access_token(
 
 @router.get("/user", response_model=schema.UserFromDB)
 async def get_self_user(
-    current_user: Annotated[schema.UserFromDB, Depends(get_current_user)]
+    current_user: Annotated[schema.UserFromDB, Depends(get_current_user)],
+    request: Request,
+    avatar_size: int | None = Query(None, ge=1),
 ):
-    return current_user
+    return user_with_avatar_urls(request, current_user, avatar_size)
 
 
 @router.post("/user", response_model=schema.UserInDB | dict)
@@ -62,6 +73,24 @@ async def create_user(
         return {'msg': 'already exist'}
 
 
+@router.post("/users/import")
+async def import_users(
+        file: UploadFile,
+        x_import_token: Annotated[str | None, Header()] = None,
+):
+    if settings.bulk_import_token is None or not secrets.compare_digest(
+            x_import_token or '', settings.bulk_import_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bulk import is not allowed")
+    # UploadFile is already spooled to disk, rows are read from it batch by batch
+    text_file = io.TextIOWrapper(file.file, encoding='utf-8', newline='')
+
+    async def results():
+        async for result in provision_users(text_file, detect_format(file.filename, file.content_type)):
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
+
+
 @router.put("/user", response_model=schema.UserInDB)
 async def update_user(
         current_user: Annotated[schema.UserInDB, Depends(get_current_user)],
@@ -71,25 +100,54 @@ async def update_user(
     return await current_user.update(session, user_to_update)
 
 
-@router.get("/users/search")
+@router.get("/users/search", response_model=schema.UsersSearch | dict)
 async def search_users(
         session: Annotated[AsyncSession, Depends(get_async_session)],
+        request: Request,
         query: str = Query(None, title="Query", description="Search query"),
+        limit: int = Query(settings.user_search_limit, ge=1, le=settings.user_search_max_limit),
+        offset: int = Query(0, ge=0),
+        avatar_size: int | None = Query(None, ge=1),
 ):
     if not query:
         return {"msg": "provide a query parameter"}
-    matching_users = await User.get_matching_users(session, query)
-    return {"users": matching_users}
+    matching_users = await User.get_matching_users(session, query, limit=limit, offset=offset)
+    return {"users": [
+        schema.PublicUser(
+            id=user.id,
+            username=user.username,
+            avatar_link=pick_avatar_variant(request, user.avatar_link, user.avatar_variants, avatar_size),
+        )
+        for user in matching_users
+    ]}
 
 
 @router.post("/user/avatar", response_model=schema.UserFromDB)
 async def add_avatar(
         current_user: Annotated[User, Depends(get_current_user)],
         session: Annotated[AsyncSession, Depends(get_async_session)],
-        avatar: Annotated[UploadFile, Depends(validate_file)]
+        avatar: Annotated[UploadFile, Depends(validate_file)],
+        background_tasks: BackgroundTasks,
+        request: Request,
 ):
     avatar_path = None
     if avatar:
-        avatar_path: str = await save_file_to_uploads(avatar, current_user.id)
-    return await current_user.add_avatar_link(session, avatar_path)
+        avatar_path: str = await save_file_to_uploads(avatar)
+    user = await current_user.add_avatar_link(session, avatar_path)
+    if avatar_path:
+        background_tasks.add_task(process_avatar, user.id, avatar_path)
+    return user_with_avatar_urls(request, user)
 
+
+@router.api_route("/avatars/{file_name}", methods=["GET", "HEAD"])
+async def get_avatar(
+        file_name: str,
+        request: Request,
+):
+    if not AVATAR_FILE_NAME.fullmatch(file_name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    try:
+        stat_result = await run_in_threadpool(os.stat, get_upload_path(file_name))
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return build_avatar_response(request, file_name, stat_result.st_size)
@@ -0,0 +1,234 @@
+"""Reproducible load benchmarks for auth, chat fan-out, history and search.
+
+Starts the app with uvicorn against a throwaway database (SQLite by default,
+or any URL passed with --database-url), seeds it and writes the results as
+JSON so runs can be compared across commits:
+
+    python -m benchmarks.run --out bench/results.json
+    python -m benchmarks.run --database-url postgresql+asyncpg://... --compare bench/results.json
+
+The database is wiped before seeding, never point it at real data.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'bench-password'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--scenarios', default='encoding,protocol,login,history,search,chat,flood,login_storm,avatars')
+    parser.add_argument('--users', type=int, default=200, help='users taking part in login/chat/history')
+    parser.add_argument('--search-users', type=int, default=10000, help='total users in the table for search')
+    parser.add_argument('--history-sizes', default='1000,10000,100000')
+    parser.add_argument('--chat-clients', type=int, default=50)
+    parser.add_argument('--chat-messages', type=int, default=20, help='messages per chat client')
+    parser.add_argument('--chat-interval', type=float, default=0.05, help='pause between messages of one client')
+    parser.add_argument('--private-ratio', type=float, default=0.3)
+    parser.add_argument('--requests', type=int, default=500, help='requests per HTTP scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--encoding-connections', default='1000,10000')
+    parser.add_argument('--avatar-images', type=int, default=40, help='1024 px uploads rendered into variants')
+    parser.add_argument('--avatar-page-senders', type=int, default=20, help='distinct senders on one history page')
+    parser.add_argument('--avatar-display-size', type=int, default=48, help='avatar size a chat client draws, px')
+    parser.add_argument('--out', help='write results JSON here')
+    parser.add_argument('--compare', help='baseline results JSON to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(port: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning'],
+        cwd=ROOT,
+        env=os.environ.copy(),
+    )
+
+
+async def wait_for_server(client, server: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('uvicorn exited during startup')
+        try:
+            await client.get('/metrics')
+            return
+        except Exception:
+            await asyncio.sleep(0.2)
+    raise RuntimeError('uvicorn did not start in time')
+
+
+async def run(args) -> dict:
+    # Settings are read on import, so the database has to be chosen first
+    import httpx
+
+    # Not used here, auth.models has to load before auth.utils to avoid a circular import
+    from auth.models import User  # noqa: F401
+    from auth.utils import create_access_token
+    from benchmarks import scenarios, seed
+    from database import engine
+
+    selected = set(args.scenarios.split(','))
+    results = {}
+
+    if 'encoding' in selected:
+        for connections in map(int, args.encoding_connections.split(',')):
+            results[f'encoding/{connections}'] = await scenarios.bench_frame_encoding(connections)
+
+    if 'protocol' in selected:
+        for name, summary in scenarios.bench_protocol_encoding().items():
+            results[f'protocol/{name}'] = summary
+
+    await seed.reset_schema()
+    users = await seed.seed_users(max(args.users, args.search_users), PASSWORD)
+    await engine.dispose()
+    bench_users = users[:args.users]
+    usernames = [username for _, username in bench_users]
+    tokens = {username: create_access_token({'sub': str(user_id)}) for user_id, username in bench_users}
+
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    ws_url = f'ws://127.0.0.1:{port}'
+    server = start_server(port)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+            await wait_for_server(client, server)
+
+            if 'login' in selected:
+                results['login'] = await scenarios.bench_login(
+                    client, usernames, PASSWORD, args.requests, args.concurrency)
+
+            if 'search' in selected:
+                results['search'] = await scenarios.bench_search(
+                    client, [username for _, username in users], args.requests, args.concurrency)
+
+            if 'chat' in selected:
+                chat = await scenarios.bench_chat(
+                    ws_url,
+                    [(username, tokens[username]) for username in usernames[:args.chat_clients]],
+                    args.chat_messages,
+                    args.private_ratio,
+                    args.chat_interval,
+                )
+                results['chat/delivery'] = chat['delivery']
+                results['chat/ack'] = chat['ack']
+
+            if 'flood' in selected:
+                flood = await scenarios.bench_chat_flood(
+                    ws_url,
+                    [(username, tokens[username]) for username in usernames[:args.chat_clients]],
+                    duration=5,
+                    interval=1.5,
+                )
+                results['flood/others_ack'] = flood.pop('others_ack')
+                results['flood'] = flood
+
+            if 'login_storm' in selected:
+                storm = await scenarios.bench_chat_during_logins(
+                    client,
+                    ws_url,
+                    [(username, tokens[username]) for username in usernames],
+                    PASSWORD,
+                    args.requests,
+                    args.concurrency,
+                    pings=50,
+                )
+                for name, summary in storm.items():
+                    results[f'login_storm/{name}'] = summary
+
+            if 'avatars' in selected:
+                for name, summary in (await scenarios.bench_avatars(
+                        client, args.avatar_images, args.avatar_page_senders, args.avatar_display_size)).items():
+                    results[f'avatars/{name}'] = summary
+
+            if 'history' in selected:
+                for size in sorted(map(int, args.history_sizes.split(','))):
+                    await seed.seed_messages(bench_users, size, args.private_ratio)
+                    await engine.dispose()
+                    results[f'history/{size}'] = await scenarios.bench_history(
+                        client, list(tokens.values()), args.requests, args.concurrency)
+                    for name, summary in (await scenarios.bench_history_query(
+                            bench_users[0][0], limit=50, rounds=args.requests)).items():
+                        results[f'history_query/{size}/{name}'] = summary
+    finally:
+        server.terminate()
+        server.wait()
+        await engine.dispose()
+    return results
+
+
+def main():
+    args = parse_args()
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    tmp_dir = None
+    if args.database_url is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        args.database_url = f"sqlite+aiosqlite:///{os.path.join(tmp_dir.name, 'bench.db')}"
+    os.environ['DB_URL'] = args.database_url
+    # Avatars rendered by the benchmark never land next to real uploads
+    upload_dir = tempfile.TemporaryDirectory()
+    os.environ['UPLOAD_FILE_PATH'] = upload_dir.name
+    os.environ.setdefault('DB_ECHO', 'false')
+    # Messages are seeded behind the server's back, a filled buffer would hide them
+    os.environ.setdefault('CHAT_TIMELINE_SIZE', '0')
+
+    results = asyncio.run(run(args))
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat(),
+            'database': args.database_url.split(':', 1)[0],
+            'python': platform.python_version(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('out', 'compare')},
+        },
+        'results': results,
+    }
+    print(json.dumps(results, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as out:
+            json.dump(report, out, indent=2)
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    upload_dir.cleanup()
+
+    if args.compare:
+        from benchmarks.stats import compare
+
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import time
+import tracemalloc
+import zlib
+from typing import Awaitable, Callable
+
+import httpx
+import websockets
+
+from benchmarks.stats import summarize
+
+
+async def run_load(request: Callable[[int], Awaitable[None]], total: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for index in counter:
+            started = time.perf_counter()
+            try:
+                await request(index)
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+async def bench_login(
+        client: httpx.AsyncClient,
+        usernames: list[str],
+        password: str,
+        total: int,
+        concurrency: int,
+) -> dict:
+    async def login(index: int):
+        response = await client.post('/auth/token', data={
+            'username': usernames[index % len(usernames)],
+            'password': password,
+        })
+        response.raise_for_status()
+
+    return await run_load(login, total, concurrency)
+
+
+async def bench_history(
+        client: httpx.AsyncClient,
+        tokens: list[str],
+        total: int,
+        concurrency: int,
+) -> dict:
+    async def load_history(index: int):
+        response = await client.get('/chat/messages', params={'token': tokens[index % len(tokens)]})
+        response.raise_for_status()
+
+    return await run_load(load_history, total, concurrency)
+
+
+async def bench_search(
+        client: httpx.AsyncClient,
+        usernames: list[str],
+        total: int,
+        concurrency: int,
+) -> dict:
+    def random_query() -> str:
+        username = random.choice(usernames)
+        start = random.randrange(0, len(username) - 3)
+        return username[start:start + 3]
+
+    async def search(index: int):
+        response = await client.get('/auth/users/search', params={'query': random_query()})
+        response.raise_for_status()
+
+    return await run_load(search, total, concurrency)
+
+
+class ChatClient:
+    def __init__(self, username: str, websocket):
+        self.username = username
+        self.websocket = websocket
+        self.delivery: list[float] = []
+        self.acks: list[float] = []
+        self.throttled = 0
+        self.reader: asyncio.Task | None = None
+
+    async def read(self):
+        async for raw in self.websocket:
+            frame = json.loads(raw)
+            if frame.get('type') == 'throttled':
+                self.throttled += 1
+                continue
+            text = frame.get('text') or ''
+            if not text.startswith('bench:'):
+                continue
+            _, sender, sent_at = text.split(':')
+            latency = time.perf_counter() - float(sent_at)
+            if sender == self.username:
+                self.acks.append(latency)
+            else:
+                self.delivery.append(latency)
+
+    async def send(self, receiver: str):
+        await self.websocket.send(json.dumps({
+            'receiver': receiver,
+            'text': f"bench:{self.username}:{time.perf_counter()}",
+        }))
+
+
+async def connect_chat_clients(ws_url: str, users: list[tuple[str, str]]) -> list[ChatClient]:
+    clients = []
+    for username, token in users:
+        websocket = await websockets.connect(f"{ws_url}/chat/ws?token={token}", max_queue=None)
+        client = ChatClient(username, websocket)
+        client.reader = asyncio.create_task(client.read())
+        clients.append(client)
+    return clients
+
+
+async def close_chat_clients(clients: list[ChatClient]):
+    for client in clients:
+        await client.websocket.close()
+        client.reader.cancel()
+
+
+async def bench_chat(
+        ws_url: str,
+        users: list[tuple[str, str]],
+        messages_per_client: int,
+        private_ratio: float,
+        interval: float,
+        drain: float = 1.0,
+) -> dict:
+    clients = await connect_chat_clients(ws_url, users)
+    usernames = [client.username for client in clients]
+
+    async def talk(client: ChatClient):
+        for _ in range(messages_per_client):
+            if random.random() < private_ratio:
+                receiver = random.choice([username for username in usernames if username != client.username])
+            else:
+                receiver = 'all'
+            await client.send(receiver)
+            await asyncio.sleep(interval)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[talk(client) for client in clients])
+    await asyncio.sleep(drain)
+    elapsed = time.perf_counter() - started - drain
+    await close_chat_clients(clients)
+
+    delivery = [latency for client in clients for latency in client.delivery]
+    acks = [latency for client in clients for latency in client.acks]
+    return {
+        'delivery': summarize(delivery, elapsed),
+        'ack': summarize(acks, elapsed),
+    }
+
+
+async def bench_chat_flood(
+        ws_url: str,
+        users: list[tuple[str, str]],
+        duration: float,
+        interval: float,
+        drain: float = 1.0,
+) -> dict:
+    """One client sends public messages as fast as it can while the others keep a normal pace."""
+    clients = await connect_chat_clients(ws_url, users)
+    flooder, others = clients[0], clients[1:]
+    sent = {client.username: 0 for client in clients}
+
+    async def talk(client: ChatClient, pause: float):
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            await client.send('all')
+            sent[client.username] += 1
+            await asyncio.sleep(pause)
+
+    started = time.perf_counter()
+    await asyncio.gather(talk(flooder, 0), *[talk(client, interval) for client in others])
+    await asyncio.sleep(drain)
+    elapsed = time.perf_counter() - started - drain
+    await close_chat_clients(clients)
+
+    return {
+        'others_ack': summarize([latency for client in others for latency in client.acks], elapsed),
+        'flooder_sent': sent[flooder.username],
+        'flooder_accepted': len(flooder.acks),
+        'flooder_throttled': flooder.throttled,
+        'others_accepted_ratio': round(
+            sum(len(client.acks) for client in others) / max(sum(sent[client.username] for client in others), 1), 3,
+        ),
+    }
+
+
+async def bench_chat_during_logins(
+        client: httpx.AsyncClient,
+        ws_url: str,
+        users: list[tuple[str, str]],
+        password: str,
+        logins: int,
+        concurrency: int,
+        pings: int,
+) -> dict:
+    """Round-trip latency of one chat pair while a login storm runs next to it."""
+    (first, second), others = users[:2], users[2:]
+    clients = await connect_chat_clients(ws_url, [first, second])
+
+    async def ping_pong(timeout: float = 30) -> list[float]:
+        for _ in range(pings):
+            await clients[0].send(clients[1].username)
+            await asyncio.sleep(0.02)
+        deadline = time.monotonic() + timeout
+        while len(clients[1].delivery) < pings and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return clients[1].delivery
+
+    idle_started = time.perf_counter()
+    idle = summarize(await ping_pong(), time.perf_counter() - idle_started)
+    clients[1].delivery = []
+
+    storm = asyncio.create_task(
+        bench_login(client, [username for username, _ in others], password, logins, concurrency)
+    )
+    storm_started = time.perf_counter()
+    during = summarize(await ping_pong(), time.perf_counter() - storm_started)
+    login = await storm
+    await close_chat_clients(clients)
+    return {'idle': idle, 'during_logins': during, 'logins': login}
+
+
+async def bench_frame_encoding(connections: int, messages: int = 20) -> dict:
+    """Per-recipient cost of ConnectionManager.broadcast with queued sockets, no network."""
+    from chat.schema import SendMessage
+    from chat.utils import Connection, ConnectionManager, dumps
+
+    manager = ConnectionManager()
+    for index in range(connections):
+        manager.active_connections[index] = [Connection(None, f"user{index}", index)]
+    message = SendMessage(receiver='all', text='x' * 64, sender='sender')
+
+    started = time.perf_counter()
+    for _ in range(messages):
+        manager.broadcast(message, -1)
+    broadcast = time.perf_counter() - started
+
+    # What the old path paid: one dict() and one JSON encoding per recipient
+    started = time.perf_counter()
+    for _ in range(messages):
+        for _ in range(connections):
+            dumps(message.dict())
+    per_recipient_encoding = time.perf_counter() - started
+
+    recipients = connections * messages
+    return {
+        'ns_per_recipient': round(broadcast / recipients * 1e9, 1),
+        'encode_per_recipient_ns': round(per_recipient_encoding / recipients * 1e9, 1),
+    }
+
+
+def deflate_frames(payloads: list[bytes]) -> list[bytes]:
+    """What permessage-deflate puts on the wire, with context takeover like the websockets defaults."""
+    compressor = zlib.compressobj(wbits=-15, memLevel=5)
+    frames = []
+    for payload in payloads:
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        frames.append(data[:-4])
+    return frames
+
+
+def bench_protocol_encoding(messages: int = 10000) -> dict:
+    """Bytes per chat frame and encode/decode CPU per message for each negotiated protocol."""
+    from chat.utils import Frame, msgpack
+
+    words = ('привет', 'hello', 'как дела', 'ok', 'завтра в 10', 'see you', 'спасибо', 'lol')
+    samples = [
+        {
+            'receiver': 'all' if index % 3 else f'user{index % 50}',
+            'text': ' '.join(random.choices(words, k=random.randint(1, 12))),
+            'sender': f'user{index % 50}',
+            'id': 1000000 + index,
+        }
+        for index in range(messages)
+    ]
+    encodings = {'json': (lambda frame: frame.text.encode(), json.loads)}
+    if msgpack is not None:
+        encodings['msgpack'] = (lambda frame: frame.binary, msgpack.unpackb)
+
+    results = {}
+    for name, (encode, decode) in encodings.items():
+        started = time.perf_counter()
+        payloads = [encode(Frame(sample)) for sample in samples]
+        encode_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for payload in payloads:
+            decode(payload)
+        decode_time = time.perf_counter() - started
+        started = time.perf_counter()
+        compressed = deflate_frames(payloads)
+        deflate_time = time.perf_counter() - started
+        results[name] = {
+            'bytes_per_message': round(sum(map(len, payloads)) / messages, 1),
+            'encode_ns': round(encode_time / messages * 1e9, 1),
+            'decode_ns': round(decode_time / messages * 1e9, 1),
+        }
+        results[f'{name}+deflate'] = {
+            'bytes_per_message': round(sum(map(len, compressed)) / messages, 1),
+            'encode_ns': round((encode_time + deflate_time) / messages * 1e9, 1),
+        }
+    return results
+
+
+async def bench_history_query(user_id: int, limit: int, rounds: int) -> dict:
+    """Rows/sec and peak Python memory of one history page, projected rows against the former ORM path."""
+    from fastapi.encoders import jsonable_encoder
+    from sqlalchemy import select, union_all
+    from sqlalchemy.orm import joinedload
+
+    from chat.models import Message
+    from chat.utils import dumps, history_item
+    from database import async_session_maker
+
+    ordering = (Message.posted.desc(), Message.id.desc())
+
+    async def orm_page(session) -> int:
+        # Message.get_chat before column projection, serialized the way FastAPI did it
+        branches = [
+            select(Message.id).filter(condition).order_by(*ordering).limit(limit).subquery()
+            for condition in Message.chat_branches(user_id)
+        ]
+        page = union_all(*[select(branch.c.id) for branch in branches]).subquery()
+        query = select(Message).options(joinedload(Message.sender)).options(joinedload(Message.receiver)).join(
+            page, Message.id == page.c.id).order_by(*ordering).limit(limit)
+        messages = (await session.execute(query)).scalars().all()
+        json.dumps(jsonable_encoder({'messages_list': messages[::-1], 'next_cursor': None}))
+        return len(messages)
+
+    async def rows_page(session) -> int:
+        messages = await Message.get_chat(session, user_id, limit)
+        dumps({'messages_list': [history_item(message) for message in messages], 'next_cursor': None})
+        return len(messages)
+
+    results = {}
+    for name, load_page in (('orm', orm_page), ('rows', rows_page)):
+        rows = 0
+        started = time.perf_counter()
+        for _ in range(rounds):
+            async with async_session_maker() as session:
+                rows += await load_page(session)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        async with async_session_maker() as session:
+            await load_page(session)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            'rows_per_second': round(rows / elapsed, 1),
+            'peak_kib': round(peak / 1024, 1),
+        }
+    return results
+
+
+def write_avatar_source(side: int) -> str:
+    """A noisy photo-sized JPEG stored like an upload, named by its content hash."""
+    from PIL import Image
+
+    from auth.utils import get_upload_path
+
+    image = Image.merge('RGB', [Image.effect_noise((side, side), 48) for _ in range(3)])
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    content = buffer.getvalue()
+    full_path = get_upload_path(f"{hashlib.sha256(content).hexdigest()}.jpg")
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'wb') as source:
+        source.write(content)
+    return full_path
+
+
+async def fetch_avatars(client: httpx.AsyncClient, paths: list[str]) -> dict:
+    latencies = []
+    served = 0
+    started = time.perf_counter()
+    for path in paths:
+        fetch_started = time.perf_counter()
+        response = await client.get(f'/auth/avatars/{os.path.basename(path)}')
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - fetch_started)
+        served += len(response.content)
+    result = summarize(latencies, time.perf_counter() - started)
+    result['bytes_per_page'] = served
+    return result
+
+
+async def bench_avatars(client: httpx.AsyncClient, images: int, page_senders: int, display_size: int) -> dict:
+    """Variant rendering throughput on the avatar process pool, and the avatar bytes one chat page costs a client.
+
+    A history page shows one avatar per distinct sender, fetched once as the original upload and
+    once as the smallest variant covering display_size.
+    """
+    from auth.avatars import avatar_executor, render_avatar_variants
+    from config import settings
+
+    sources = [await asyncio.to_thread(write_avatar_source, 1024) for _ in range(images)]
+    loop = asyncio.get_running_loop()
+    latencies = []
+
+    async def render(source: str) -> dict[str, str]:
+        started = time.perf_counter()
+        variants = await loop.run_in_executor(avatar_executor, render_avatar_variants, source, settings.avatar_sizes)
+        latencies.append(time.perf_counter() - started)
+        return variants
+
+    started = time.perf_counter()
+    rendered = await asyncio.gather(*[render(source) for source in sources])
+    results = {'pipeline': summarize(latencies, time.perf_counter() - started)}
+
+    sizes = sorted(settings.avatar_sizes)
+    variant_size = next((size for size in sizes if size >= display_size), sizes[-1])
+    page = min(page_senders, images)
+    results['page/original'] = await fetch_avatars(client, sources[:page])
+    results[f'page/{variant_size}px'] = await fetch_avatars(
+        client, [variants[str(variant_size)] for variants in rendered[:page]])
+    return results
@@ -0,0 +1,58 @@
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select, text
+
+from auth.models import User
+from auth.utils import get_password_hash
+from chat.models import Message
+from database import Base, async_session_maker, engine
+
+NAMES = ('alex', 'maria', 'ivan', 'olga', 'dmitry', 'anna', 'sergey', 'elena', 'pavel', 'irina')
+BATCH_SIZE = 1000
+
+
+async def reset_schema():
+    async with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            await connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+
+
+def bench_username(index: int) -> str:
+    return f"{NAMES[index % len(NAMES)]}_{index:07d}"
+
+
+async def seed_users(count: int, password: str) -> list[tuple[int, str]]:
+    # bcrypt is slow on purpose, every seeded user shares one hash
+    hash_password = get_password_hash(password)
+    async with async_session_maker() as session:
+        for start in range(0, count, BATCH_SIZE):
+            rows = [
+                {'username': bench_username(index), 'hash_password': hash_password}
+                for index in range(start, min(start + BATCH_SIZE, count))
+            ]
+            await session.execute(insert(User), rows)
+        await session.commit()
+        result = await session.execute(select(User.id, User.username).order_by(User.id))
+        return [tuple(row) for row in result.all()]
+
+
+async def seed_messages(users: list[tuple[int, str]], total: int, private_ratio: float):
+    async with async_session_maker() as session:
+        existing = await session.scalar(select(func.count()).select_from(Message))
+        posted = datetime.utcnow() - timedelta(seconds=total)
+        for start in range(existing, total, BATCH_SIZE):
+            rows = []
+            for index in range(start, min(start + BATCH_SIZE, total)):
+                sender_id = random.choice(users)[0]
+                receiver_id = random.choice(users)[0] if random.random() < private_ratio else None
+                rows.append({
+                    'text': f"seeded message {index}",
+                    'sender_id': sender_id,
+                    'receiver_id': receiver_id,
+                    'posted': posted + timedelta(seconds=index),
+                })
+            await session.execute(insert(Message), rows)
+        await session.commit()
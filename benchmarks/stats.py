@@ -0,0 +1,41 @@
+import math
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize(latencies: list[float], elapsed: float, errors: int = 0) -> dict:
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        'throughput': round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+LOWER_IS_BETTER = (
+    'p50_ms', 'p99_ms', 'ns_per_recipient', 'bytes_per_message', 'us_per_message', 'peak_kib', 'bytes_per_page',
+)
+HIGHER_IS_BETTER = ('throughput', 'rows_per_second')
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in current.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for key in LOWER_IS_BETTER:
+            if previous.get(key) and result.get(key, 0) > previous[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {previous[key]} -> {result[key]}")
+        for key in HIGHER_IS_BETTER:
+            if previous.get(key) and result.get(key, 0) < previous[key] * (1 - tolerance):
+                regressions.append(f"{name} {key}: {previous[key]} -> {result[key]}")
+    return regressions
@@ -1,9 +1,15 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, select, DateTime, or_, func
+import random
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, ForeignKey, select, insert, update, DateTime, Index, and_, case, \
+    func, tuple_, union_all
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import relationship, joinedload
+from sqlalchemy.orm import relationship, aliased
 
 from auth import schema as user_schema
-from database import Base
+from auth.models import User
+from config import settings
+from database import Base, db_now, dialect_insert
 
 
 class Message(Base):
@@ -19,20 +25,79 @@ class Message(Base):
     receiver_id = Column(Integer, ForeignKey("user.id"), nullable=True)
     receiver = relationship("User", foreign_keys=[receiver_id], uselist=False, back_populates="private_messages")
 
-    posted = Column(DateTime, default=func.now())
+    # Partition key, the table's primary key is (id, posted), see chat/partitions.py
+    posted = Column(DateTime, default=db_now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_message_sender_id_posted', 'sender_id', 'posted', 'id'),
+        Index('ix_message_receiver_id_posted', 'receiver_id', 'posted', 'id'),
+        Index(
+            'ix_message_public_posted', 'posted', 'id',
+            postgresql_where=receiver_id.is_(None),
+            sqlite_where=receiver_id.is_(None),
+        ),
+    )
+
+    @classmethod
+    def chat_branches(cls, user_id: int, public: bool = True):
+        # Disjoint parts of a user's chat, each one served by its own index
+        private = (
+            and_(cls.sender_id == user_id, cls.receiver_id.isnot(None)),
+            and_(cls.receiver_id == user_id, cls.sender_id.is_distinct_from(user_id)),
+        )
+        return (cls.receiver_id.is_(None), *private) if public else private
+
+    @classmethod
+    def select_rows(cls, page, *ordering):
+        # Plain rows, only what a chat client shows, no User entities
+        sender = aliased(User)
+        receiver = aliased(User)
+        # posted is the partition key, joining on it lets each probe skip the other partitions
+        return select(
+            cls.id, cls.text, cls.posted, sender.username.label('sender'), receiver.username.label('receiver'),
+        ).join(page, and_(cls.id == page.c.id, cls.posted == page.c.posted)).outerjoin(
+            sender, sender.id == cls.sender_id).outerjoin(receiver, receiver.id == cls.receiver_id).order_by(*ordering)
 
     @classmethod
     async def get_chat(
             cls,
             session: AsyncSession,
             user_id: int,
+            limit: int,
+            before: tuple[datetime, int] | None = None,
+            after: tuple[datetime, int] | None = None,
+            public: bool = True,
     ):
-        query = select(cls).options(joinedload(cls.sender)).options(joinedload(cls.receiver)).filter(or_(
-            cls.sender_id == user_id,
-            cls.receiver_id.is_(None),
-            cls.receiver_id == user_id)).order_by(cls.posted)
-        result = await session.execute(query)
-        return result.scalars().all()
+        if after is not None:
+            keyset = [tuple_(cls.posted, cls.id) > tuple_(*after)]
+            ordering = (cls.posted, cls.id)
+        else:
+            keyset = [tuple_(cls.posted, cls.id) < tuple_(*before)] if before is not None else []
+            ordering = (cls.posted.desc(), cls.id.desc())
+        branches = [
+            select(cls.id, cls.posted).filter(condition, *keyset).order_by(*ordering).limit(limit).subquery()
+            for condition in cls.chat_branches(user_id, public)
+        ]
+        page = union_all(*[select(branch.c.id, branch.c.posted) for branch in branches]).subquery()
+        result = await session.execute(cls.select_rows(page, *ordering).limit(limit))
+        messages = result.all()
+        return messages if after is not None else messages[::-1]
+
+    @classmethod
+    async def get_since(
+            cls,
+            session: AsyncSession,
+            user_id: int,
+            last_seen_id: int,
+            limit: int,
+    ):
+        branches = [
+            select(cls.id, cls.posted).filter(condition, cls.id > last_seen_id).order_by(cls.id).limit(limit).subquery()
+            for condition in cls.chat_branches(user_id)
+        ]
+        page = union_all(*[select(branch.c.id, branch.c.posted) for branch in branches]).subquery()
+        result = await session.execute(cls.select_rows(page, cls.id).limit(limit))
+        return result.all()
 
     @classmethod
     async def create(
@@ -42,8 +107,178 @@ class Message(Base):
             sender: user_schema.UserInDB,
             receiver: user_schema.UserInDB,
     ):
-        message = cls(text=text, sender=sender, receiver=receiver)
+        message = cls(text=text, sender_id=sender.id, receiver_id=receiver.id if receiver else None)
         session.add(message)
+        await session.flush()
+        await Conversation.record(session, [message])
         await session.commit()
+        return message
+
+    @classmethod
+    async def create_many(
+            cls,
+            session: AsyncSession,
+            rows: list[dict],
+    ):
+        query = insert(cls).returning(cls, sort_by_parameter_order=True)
+        result = await session.scalars(query, rows)
+        messages = result.all()
+        await Conversation.record(session, messages)
+        await session.commit()
+        return messages
+
 
+class Conversation(Base):
+    """Per-user chat summary, kept up to date by Message.create and create_many.
 
+    A row with user_id and peer_id is one side of a private chat. The public chat
+    is counted in shard rows (user_id NULL), each writer bumps a random one so public
+    senders don't queue on a single row lock, and the total is their sum. One row per
+    user (peer_id NULL) holds how many public messages that user has read.
+    """
+    __tablename__ = 'conversation'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=True)
+    peer_id = Column(Integer, ForeignKey("user.id"), nullable=True)
+    last_message_id = Column(Integer, nullable=True)
+    last_posted = Column(DateTime, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0, server_default='0')
+    message_count = Column(Integer, nullable=False, default=0, server_default='0')
+    read_count = Column(Integer, nullable=False, default=0, server_default='0')
+    shard = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index(
+            'ux_conversation_user_peer', 'user_id', 'peer_id', unique=True,
+            postgresql_where=peer_id.isnot(None),
+            sqlite_where=peer_id.isnot(None),
+        ),
+        Index(
+            'ux_conversation_user_public', 'user_id', unique=True,
+            postgresql_where=and_(user_id.isnot(None), peer_id.is_(None)),
+            sqlite_where=and_(user_id.isnot(None), peer_id.is_(None)),
+        ),
+        Index(
+            'ux_conversation_public_shard', 'shard', unique=True,
+            postgresql_where=user_id.is_(None),
+            sqlite_where=user_id.is_(None),
+        ),
+    )
+
+    @classmethod
+    def newer(cls, column, excluded):
+        return case((excluded.last_message_id > func.coalesce(cls.last_message_id, 0), excluded[column]),
+                    else_=getattr(cls, column))
+
+    @classmethod
+    async def record(cls, session: AsyncSession, messages):
+        """Fold new messages into the summaries inside the caller's transaction."""
+        private: dict[tuple[int, int], dict] = {}
+        public_senders: set[int] = set()
+        public_count = 0
+        public_last = None
+        for message in messages:
+            if message.receiver_id is None:
+                public_count += 1
+                public_senders.add(message.sender_id)
+                public_last = message
+                continue
+            sides = [(message.sender_id, message.receiver_id, 0)]
+            if message.receiver_id != message.sender_id:
+                sides.append((message.receiver_id, message.sender_id, 1))
+            for user_id, peer_id, unread in sides:
+                row = private.setdefault((user_id, peer_id), {
+                    'user_id': user_id, 'peer_id': peer_id, 'unread_count': 0,
+                })
+                row['unread_count'] += unread
+                row['last_message_id'] = message.id
+                row['last_posted'] = message.posted
+
+        if private:
+            # Sorted keys keep concurrent writers locking rows in the same order
+            query = dialect_insert(session, cls)
+            query = query.on_conflict_do_update(
+                index_elements=['user_id', 'peer_id'],
+                index_where=cls.peer_id.isnot(None),
+                set_={
+                    'unread_count': cls.unread_count + query.excluded.unread_count,
+                    'last_message_id': cls.newer('last_message_id', query.excluded),
+                    'last_posted': cls.newer('last_posted', query.excluded),
+                },
+            )
+            await session.execute(query.values([private[key] for key in sorted(private)]))
+
+        if public_count:
+            query = dialect_insert(session, cls)
+            query = query.on_conflict_do_update(
+                index_elements=['shard'],
+                index_where=cls.user_id.is_(None),
+                set_={
+                    'message_count': cls.message_count + query.excluded.message_count,
+                    'last_message_id': cls.newer('last_message_id', query.excluded),
+                    'last_posted': cls.newer('last_posted', query.excluded),
+                },
+            )
+            await session.execute(query.values(
+                shard=random.randrange(settings.chat_public_counter_shards),
+                message_count=public_count,
+                last_message_id=public_last.id,
+                last_posted=public_last.posted,
+            ))
+            # Posting to the public chat marks it read for the sender
+            await cls.mark_public_read(session, sorted(public_senders), await cls.public_count(session))
+
+    @classmethod
+    async def public_count(cls, session: AsyncSession) -> int:
+        return await session.scalar(select(func.coalesce(func.sum(cls.message_count), 0)).filter(
+            cls.user_id.is_(None)))
+
+    @classmethod
+    async def mark_public_read(cls, session: AsyncSession, user_ids: list[int], read_count):
+        query = dialect_insert(session, cls)
+        query = query.on_conflict_do_update(
+            index_elements=['user_id'],
+            index_where=and_(cls.user_id.isnot(None), cls.peer_id.is_(None)),
+            # A stale or concurrent mark must not move the marker back
+            set_={'read_count': case((query.excluded.read_count > cls.read_count, query.excluded.read_count),
+                                     else_=cls.read_count)},
+        )
+        await session.execute(query.values([
+            {'user_id': user_id, 'peer_id': None, 'read_count': read_count} for user_id in user_ids
+        ]))
+
+    @classmethod
+    async def catch_up_public(cls, session: AsyncSession, user_ids: list[int]):
+        """Mark every public message posted so far as read, also used for new users."""
+        await cls.mark_public_read(session, user_ids, await cls.public_count(session))
+
+    @classmethod
+    async def mark_read(cls, session: AsyncSession, user_id: int, peer_id: int | None):
+        if peer_id is None:
+            await cls.catch_up_public(session, [user_id])
+        else:
+            await session.execute(update(cls).filter(cls.user_id == user_id, cls.peer_id == peer_id).values(
+                unread_count=0))
+        await session.commit()
+
+    @classmethod
+    async def get_list(cls, session: AsyncSession, user_id: int):
+        peer = aliased(User)
+        own_public = aliased(cls)
+        private = select(
+            peer.username.label('peer'), cls.last_message_id, cls.last_posted, cls.unread_count,
+        ).join(peer, peer.id == cls.peer_id).filter(cls.user_id == user_id)
+        shards = select(
+            func.max(cls.last_message_id).label('last_message_id'),
+            func.max(cls.last_posted).label('last_posted'),
+            func.sum(cls.message_count).label('message_count'),
+        ).filter(cls.user_id.is_(None)).subquery()
+        public = select(
+            shards.c.last_message_id, shards.c.last_posted,
+            (shards.c.message_count - func.coalesce(own_public.read_count, 0)).label('unread_count'),
+        ).outerjoin(own_public, and_(own_public.user_id == user_id, own_public.peer_id.is_(None))).filter(
+            shards.c.message_count.isnot(None))
+        private_rows = (await session.execute(private)).all()
+        public_row = (await session.execute(public)).first()
+        return private_rows, public_row
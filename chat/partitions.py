@@ -0,0 +1,165 @@
+"""Maintenance of the monthly `message` partitions (PostgreSQL only).
+
+    python -m chat.partitions create --months-ahead 3
+    python -m chat.partitions archive --older-than 12 --path archive/
+
+`create` adds the partitions for the coming months, it also runs on startup.
+Rows posted before their month's partition existed wait in `message_default`,
+`create` moves them into the new partition.
+`archive` dumps every partition that ended more than N months ago into a
+gzipped CSV file, then detaches and drops it.
+"""
+import argparse
+import asyncio
+import gzip
+import os
+from datetime import date, datetime
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from config import settings
+from database import engine
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"message_p{month:%Y_%m}"
+
+
+async def is_partitioned(connection: AsyncConnection) -> bool:
+    if connection.dialect.name != 'postgresql':
+        return False
+    result = await connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('message')"
+    ))
+    return result.scalar() is not None
+
+
+async def list_partitions(connection: AsyncConnection) -> list[date]:
+    result = await connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'message'::regclass"
+    ))
+    months = []
+    for name in result.scalars():
+        try:
+            months.append(datetime.strptime(name, 'message_p%Y_%m').date())
+        except ValueError:
+            continue
+    return sorted(months)
+
+
+async def has_default_partition(connection: AsyncConnection) -> bool:
+    result = await connection.execute(text(
+        "SELECT partdefid <> 0 FROM pg_partitioned_table WHERE partrelid = 'message'::regclass"
+    ))
+    return bool(result.scalar())
+
+
+async def create_partition(connection: AsyncConnection, month: date, has_default: bool):
+    name = partition_name(month)
+    bounds = f"FROM ('{month}') TO ('{add_months(month, 1)}')"
+    if not has_default:
+        await connection.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF message FOR VALUES {bounds}"))
+        return
+    # The new range may not overlap rows in the default partition, so they are moved out before it is
+    # attached. Locking only the default partition keeps inserts waiting without a deadlock on message
+    await connection.execute(text("LOCK TABLE message_default IN ACCESS EXCLUSIVE MODE"))
+    await connection.execute(text(f"CREATE TABLE {name} (LIKE message INCLUDING DEFAULTS)"))
+    await connection.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM message_default
+            WHERE posted >= '{month}' AND posted < '{add_months(month, 1)}'
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """))
+    await connection.execute(text(f"ALTER TABLE message ATTACH PARTITION {name} FOR VALUES {bounds}"))
+
+
+async def create_partitions(connection: AsyncConnection, months_ahead: int) -> list[str]:
+    if not await is_partitioned(connection):
+        return []
+    existing = set(await list_partitions(connection))
+    has_default = await has_default_partition(connection)
+    current = month_start(datetime.utcnow().date())
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if month in existing:
+            continue
+        await create_partition(connection, month, has_default)
+        created.append(partition_name(month))
+    return created
+
+
+async def archive_partition(connection: AsyncConnection, month: date, path: str) -> str:
+    name = partition_name(month)
+    os.makedirs(path, exist_ok=True)
+    archive = os.path.join(path, f"{name}.csv.gz")
+    tmp = f"{archive}.tmp"
+    raw = await connection.get_raw_connection()
+    with gzip.open(tmp, 'wb') as out:
+        async def write(chunk: bytes):
+            out.write(chunk)
+
+        await raw.driver_connection.copy_from_table(name, output=write, format='csv', header=True)
+    with open(tmp, 'rb') as out:
+        os.fsync(out.fileno())
+    os.replace(tmp, archive)
+    # Only dropped once the rows are safely on disk
+    await connection.execute(text(f"ALTER TABLE message DETACH PARTITION {name}"))
+    await connection.execute(text(f"DROP TABLE {name}"))
+    return archive
+
+
+async def cold_partitions(connection: AsyncConnection, older_than: int) -> list[date]:
+    cutoff = add_months(month_start(datetime.utcnow().date()), -older_than)
+    return [month for month in await list_partitions(connection) if add_months(month, 1) <= cutoff]
+
+
+async def run(args):
+    try:
+        if args.command == 'create':
+            async with engine.begin() as connection:
+                names = await create_partitions(connection, args.months_ahead)
+        else:
+            names = []
+            async with engine.connect() as connection:
+                if not await is_partitioned(connection):
+                    print('message is not partitioned')
+                    return
+                months = await cold_partitions(connection, args.older_than)
+                await connection.commit()
+                for month in months:
+                    # One transaction per partition, a failure keeps the ones already done
+                    async with connection.begin():
+                        names.append(await archive_partition(connection, month, args.path))
+    finally:
+        await engine.dispose()
+    for name in names:
+        print(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create')
+    create.add_argument('--months-ahead', type=int, default=settings.chat_partition_months_ahead)
+    archive = commands.add_parser('archive')
+    archive.add_argument('--older-than', type=int, default=settings.chat_archive_after_months)
+    archive.add_argument('--path', default=settings.chat_archive_path)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+    def retry_after(self, now: float) -> float:
+        """0 when a token is available, otherwise seconds until one is."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+
+class RateLimiter:
+    """Token buckets per connection and per user, one pair for each message kind."""
+
+    def __init__(self, limits: dict[str, tuple[float, float]], user_factor: float):
+        # kind -> (refill per second, burst)
+        self.limits = limits
+        self.user_factor = user_factor
+        # Keyed by user id, a rename must not hand out a fresh bucket
+        self.user_buckets: OrderedDict[tuple[int, str], TokenBucket] = OrderedDict()
+
+    def _user_bucket(self, user_id: int, kind: str, now: float) -> TokenBucket:
+        key = (user_id, kind)
+        bucket = self.user_buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[kind]
+            bucket = TokenBucket(rate * self.user_factor, burst * self.user_factor, now)
+            self.user_buckets[key] = bucket
+        else:
+            self.user_buckets.move_to_end(key)
+        # A full bucket carries no state, dropping idle ones keeps the dict bounded
+        while True:
+            oldest_key, oldest = next(iter(self.user_buckets.items()))
+            if oldest is bucket or not oldest.is_full(now):
+                break
+            del self.user_buckets[oldest_key]
+        return bucket
+
+    def check(self, buckets: dict[str, TokenBucket], user_id: int, kind: str) -> tuple[str, float] | None:
+        """Take a token from the connection and the user bucket, or say which one is empty and for how long."""
+        now = time.monotonic()
+        connection_bucket = buckets.get(kind)
+        if connection_bucket is None:
+            connection_bucket = buckets[kind] = TokenBucket(*self.limits[kind], now)
+        user_bucket = self._user_bucket(user_id, kind, now)
+        retry_after = connection_bucket.retry_after(now)
+        if retry_after:
+            return 'connection', retry_after
+        retry_after = user_bucket.retry_after(now)
+        if retry_after:
+            return 'user', retry_after
+        connection_bucket.tokens -= 1
+        user_bucket.tokens -= 1
+        return None
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from pydantic import BaseModel
 
 
@@ -8,3 +10,28 @@ class ReceiveMessage(BaseModel):
 
 class SendMessage(ReceiveMessage):
     sender: str
+    id: int | None = None
+
+
+class HistoryMessage(BaseModel):
+    id: int
+    text: str | None
+    posted: datetime
+    sender: str | None
+    receiver: str | None = None
+
+
+class ChatHistory(BaseModel):
+    messages_list: list[HistoryMessage]
+    next_cursor: str | None = None
+
+
+class ConversationSummary(BaseModel):
+    peer: str
+    last_message_id: int | None = None
+    last_posted: datetime | None = None
+    unread_count: int
+
+
+class Conversations(BaseModel):
+    conversations: list[ConversationSummary]
@@ -0,0 +1,72 @@
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth.models import User
+from chat.models import Message
+
+
+class TimelineEntry(NamedTuple):
+    id: int
+    posted: datetime
+    sender_id: int
+    sender: str
+    text: str
+
+    @property
+    def receiver(self) -> None:
+        return None
+
+
+def entry_key(entry: TimelineEntry) -> tuple[datetime, int]:
+    return entry.posted, entry.id
+
+
+class PublicTimeline:
+    """The newest public messages of this worker, kept in (posted, id) order.
+
+    Only messages sent through this worker are appended, so it is meant for single-worker deployments.
+    """
+
+    def __init__(self, size: int):
+        self.entries: deque[TimelineEntry] = deque(maxlen=size)
+
+    @property
+    def enabled(self) -> bool:
+        return self.entries.maxlen > 0
+
+    async def fill(self, session: AsyncSession):
+        if not self.enabled:
+            return
+        query = select(Message.id, Message.posted, Message.sender_id, User.username, Message.text).join(
+            User, User.id == Message.sender_id).filter(Message.receiver_id.is_(None)).order_by(
+            Message.posted.desc(), Message.id.desc()).limit(self.entries.maxlen)
+        rows = (await session.execute(query)).all()
+        self.entries.clear()
+        self.entries.extend(TimelineEntry(*row) for row in reversed(rows))
+
+    def append(self, message_id: int, posted: datetime, sender_id: int, sender: str, text: str):
+        if not self.enabled:
+            return
+        entry = TimelineEntry(message_id, posted, sender_id, sender, text)
+        if not self.entries or entry_key(self.entries[-1]) <= entry_key(entry):
+            self.entries.append(entry)
+        else:
+            # Concurrent commits can finish out of order, keep the buffer sorted
+            entries = sorted([*self.entries, entry], key=entry_key)
+            self.entries.clear()
+            self.entries.extend(entries)
+
+    def page(self, limit: int, before: tuple[datetime, int] | None = None) -> list[TimelineEntry] | None:
+        """Up to `limit` entries older than `before`, or None when the DB has to answer."""
+        if not self.enabled:
+            return None
+        end = len(self.entries) if before is None else bisect_left(self.entries, before, key=entry_key)
+        # A short buffer can't tell whether older rows exist, they may come from another writer
+        if end < limit:
+            return None
+        return [self.entries[index] for index in range(max(end - limit, 0), end)]
@@ -1,55 +1,322 @@
-from typing import Annotated
+import asyncio
+import base64
+import binascii
+import json
+import time
+from datetime import datetime
+from typing import Annotated, NamedTuple
 
 from fastapi import (
     Query,
     WebSocketException,
+    HTTPException,
     status,
-    Depends,
     WebSocket,
 )
 
-from sqlalchemy.ext.asyncio import AsyncSession
-
-from auth.utils import get_current_user
+from auth.models import User
+from auth.utils import get_current_user, username_cache
+from chat.models import Message
+from chat.ratelimit import TokenBucket
 from chat.schema import SendMessage
-from database import get_async_session
+from config import settings
+from database import async_session_maker
+from metrics import chat_broadcast_duration
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SUBPROTOCOLS = {'chat.json': 'json', 'chat.msgpack': 'msgpack'}
 
 
 async def get_chat_user_by_token(
         token: Annotated[str | None, Query()] = None,
-        session: AsyncSession = Depends(get_async_session),
 ):
     if token is None:
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
-    current_user = await get_current_user(token, session)
+    async with async_session_maker() as session:
+        current_user = await get_current_user(token, session)
     return current_user
 
 
+def encode_cursor(posted: datetime, message_id: int) -> str:
+    raw = f"{posted.isoformat()}|{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        posted, message_id = raw.split("|")
+        return datetime.fromisoformat(posted), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def dumps(data: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class Frame:
+    """Outbound payload encoded at most once per encoding and shared by every recipient."""
+    __slots__ = ('data', 'message_id', '_text', '_binary')
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.message_id = data.get('id')
+        self._text = None
+        self._binary = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = dumps(self.data)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = msgpack.packb(self.data)
+        return self._binary
+
+
+def negotiate_encoding(websocket: WebSocket, encoding: str | None = None) -> tuple[str, str | None]:
+    """Frame encoding and accepted subprotocol, from the offered subprotocols or the ?encoding= flag."""
+    for subprotocol in websocket.scope.get('subprotocols', []):
+        if subprotocol in SUBPROTOCOLS and (SUBPROTOCOLS[subprotocol] != 'msgpack' or msgpack is not None):
+            return SUBPROTOCOLS[subprotocol], subprotocol
+    if encoding == 'msgpack' and msgpack is not None:
+        return 'msgpack', None
+    return 'json', None
+
+
+def message_to_schema(message) -> SendMessage:
+    return SendMessage(
+        id=message.id,
+        receiver=message.receiver or 'all',
+        text=message.text,
+        sender=message.sender,
+    )
+
+
+def history_item(message) -> dict:
+    """HistoryMessage as a plain dict, for rows from Message.get_chat and timeline entries alike."""
+    return {
+        'id': message.id,
+        'text': message.text,
+        'posted': message.posted.isoformat(),
+        'sender': message.sender,
+        'receiver': message.receiver,
+    }
+
+
+class ChatUser(NamedTuple):
+    id: int
+    username: str
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, username: str, user_id: int, encoding: str = 'json'):
+        self.websocket = websocket
+        self.username = username
+        self.user_id = user_id
+        self.encoding = encoding
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.chat_send_queue_size)
+        self.writer: asyncio.Task | None = None
+        # Live frames held back while replay() runs, unbounded so none are dropped meanwhile
+        self.pending: list[Frame] | None = None
+        self.buckets: dict[str, TokenBucket] = {}
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.send(frame)
+        except Exception:
+            # The socket is gone, the receive loop will clean the connection up
+            pass
+
+    async def send(self, frame: Frame):
+        if self.encoding == 'msgpack':
+            await self.websocket.send_bytes(frame.binary)
+        else:
+            await self.websocket.send_text(frame.text)
+
+    async def receive(self) -> dict:
+        if self.encoding == 'msgpack':
+            return msgpack.unpackb(await self.websocket.receive_bytes())
+        return await self.websocket.receive_json()
+
+    async def replay(self, last_seen_id: int):
+        """Send the messages persisted after last_seen_id, then the live frames that arrived meanwhile.
+
+        The caller sets pending before the connection is registered, so no live frame slips past the buffer.
+        """
+        replayed = set()
+        while True:
+            async with async_session_maker() as session:
+                messages = await Message.get_since(session, self.user_id, last_seen_id, settings.chat_page_size)
+            for message in messages:
+                replayed.add(message.id)
+                await self.send(Frame(message_to_schema(message).dict()))
+            if len(messages) < settings.chat_page_size:
+                break
+            last_seen_id = messages[-1].id
+        while self.pending:
+            frames, self.pending = self.pending, []
+            for frame in frames:
+                if frame.message_id not in replayed:
+                    await self.send(frame)
+        self.pending = None
+
+    def put(self, frame: Frame) -> bool:
+        if self.pending is not None:
+            self.pending.append(frame)
+            return True
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            if settings.chat_overflow_policy == 'disconnect':
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(frame)
+        return True
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.cancel()
+
+    async def close(self, code: int):
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except RuntimeError:
+            pass
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[str, WebSocket] = {}
+    """Open sockets of this worker, grouped by user id so several devices can be online at once.
 
-    async def connect(self, websocket: WebSocket, username: str):
-        await websocket.accept()
-        self.active_connections.update({username: websocket})
+    Keyed by id rather than username, a rename must not hand a user's messages to whoever takes the old name.
+    """
 
-    def disconnect(self, username: str):
-        del self.active_connections[username]
+    def __init__(self):
+        self.active_connections: dict[int, list[Connection]] = {}
+        self._closing: set[asyncio.Task] = set()
 
-    async def send_personal_message(self, message: SendMessage):
-        if message.receiver == 'all':
-            try:
-                await self.active_connections[message.sender].send_json(message.dict())
-            except KeyError:
-                pass
+    async def connect(
+            self,
+            websocket: WebSocket,
+            username: str,
+            user_id: int,
+            last_seen_id: int | None = None,
+            encoding: str | None = None,
+    ) -> Connection:
+        encoding, subprotocol = negotiate_encoding(websocket, encoding)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(websocket, username, user_id, encoding)
+        if last_seen_id is not None:
+            connection.pending = []
+        # Registered before the replay query so nothing committed in between is missed
+        self.add(connection)
+        # The snapshot leads, presence deltas and messages that follow are applied on top of it
+        snapshot = Frame({'type': 'presence', 'users': self.online_users()})
+        if last_seen_id is None:
+            connection.put(snapshot)
         else:
             try:
-                await self.active_connections[message.receiver].send_json(message.dict())
-                await self.active_connections[message.sender].send_json(message.dict())
-            except KeyError:
-                pass
-
-    async def broadcast(self, message: SendMessage):
-        for username, websocket in self.active_connections.items():
-            if username != message.sender:
-                await websocket.send_json(message.dict())
+                await connection.send(snapshot)
+                await connection.replay(last_seen_id)
+            except Exception:
+                self.disconnect(connection)
+                raise
+        connection.start()
+        return connection
+
+    def add(self, connection: Connection):
+        connections = self.active_connections.setdefault(connection.user_id, [])
+        connections.append(connection)
+        if len(connections) == 1:
+            self._broadcast_frame(Frame({'type': 'presence', 'joined': [connection.username]}), connection.user_id)
+
+    def disconnect(self, connection: Connection) -> bool:
+        """Forget a connection, returns True when it was the user's last one."""
+        connection.stop()
+        connections = self.active_connections.get(connection.user_id)
+        if connections is None or connection not in connections:
+            return False
+        connections.remove(connection)
+        if connections:
+            return False
+        del self.active_connections[connection.user_id]
+        self._broadcast_frame(Frame({'type': 'presence', 'left': [connection.username]}), connection.user_id)
+        return True
+
+    def online_users(self) -> list[str]:
+        return [connections[0].username for connections in self.active_connections.values()]
+
+    def _send(self, connection: Connection, frame: Frame):
+        if not connection.put(frame):
+            # Deferred so a leave event is not broadcast from inside another broadcast
+            asyncio.get_running_loop().call_soon(self.disconnect, connection)
+            # Try again later, a slow reader may reconnect and replay what it missed
+            task = asyncio.create_task(connection.close(code=status.WS_1013_TRY_AGAIN_LATER))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    def _send_to_user(self, user_id: int, frame: Frame):
+        for connection in list(self.active_connections.get(user_id, ())):
+            self._send(connection, frame)
+
+    def _broadcast_frame(self, frame: Frame, exclude: int):
+        for user_id, connections in list(self.active_connections.items()):
+            if user_id != exclude:
+                for connection in list(connections):
+                    self._send(connection, frame)
+
+    def send_personal_message(self, message: SendMessage, sender_id: int, receiver_id: int | None = None):
+        frame = Frame(message.dict())
+        if receiver_id is not None and receiver_id != sender_id:
+            self._send_to_user(receiver_id, frame)
+        self._send_to_user(sender_id, frame)
+
+    def broadcast(self, message: SendMessage, sender_id: int):
+        started = time.perf_counter()
+        self._broadcast_frame(Frame(message.dict()), sender_id)
+        chat_broadcast_duration.observe(time.perf_counter() - started)
+
+    def _all_connections(self):
+        for connections in self.active_connections.values():
+            yield from connections
+
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self.active_connections.values())
+
+    def queue_depth(self) -> int:
+        return sum(connection.queue.qsize() for connection in self._all_connections())
+
+    def max_queue_depth(self) -> int:
+        return max((connection.queue.qsize() for connection in self._all_connections()), default=0)
+
+
+async def load_chat_user(username: str) -> ChatUser | None:
+    async with async_session_maker() as session:
+        user = await User.get_by_username(session, username)
+    return ChatUser(user.id, user.username) if user else None
+
+
+async def resolve_chat_user(username: str) -> ChatUser | None:
+    # Not taken from live connections, their usernames are the ones from connect time
+    return await username_cache.get_or_load(username, lambda: load_chat_user(username))
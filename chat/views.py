@@ -1,21 +1,35 @@
+import heapq
+from datetime import datetime
+from functools import partial
 from typing import Annotated
 
+from pydantic import ValidationError
 from fastapi import (
     WebSocket,
     WebSocketDisconnect,
     APIRouter,
     Depends,
-    Request)
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status)
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from starlette.templating import Jinja2Templates
 
-from auth.models import User
 from auth.schema import UserInDB
-from chat.models import Message
-from chat.utils import ConnectionManager, get_chat_user_by_token
-from database import get_async_session
-from chat.schema import ReceiveMessage, SendMessage
+from chat.models import Conversation, Message
+from chat.partitions import create_partitions
+from chat.ratelimit import RateLimiter
+from chat.timeline import PublicTimeline
+from chat.writer import MessageWriter
+from chat.utils import ConnectionManager, Frame, get_chat_user_by_token, resolve_chat_user, encode_cursor, \
+    decode_cursor, dumps, history_item
+from config import settings
+from database import get_async_session, async_session_maker, engine
+from metrics import chat_private_messages, chat_public_messages, chat_throttled_messages, registry
+from chat.schema import ChatHistory, ConversationSummary, Conversations, ReceiveMessage, SendMessage
 
 router = APIRouter(
     prefix="/chat",
@@ -23,9 +37,49 @@ router = APIRouter(
 )
 
 manager = ConnectionManager()
+registry.gauge_callback('chat_active_connections', 'Open chat WebSocket connections.', manager.connection_count)
+registry.gauge_callback('chat_online_users', 'Users with at least one open chat connection.',
+                        lambda: len(manager.active_connections))
+registry.gauge_callback('chat_send_queue_depth', 'Frames waiting in all outbound queues.', manager.queue_depth)
+registry.gauge_callback('chat_send_queue_depth_max', 'Deepest outbound queue.', manager.max_queue_depth)
+writer = MessageWriter(
+    batch_size=settings.chat_flush_size,
+    interval_ms=settings.chat_flush_interval_ms,
+)
+limiter = RateLimiter(
+    limits={
+        'public': (settings.chat_public_rate, settings.chat_public_burst),
+        'private': (settings.chat_private_rate, settings.chat_private_burst),
+    },
+    user_factor=settings.chat_user_rate_factor,
+)
+timeline = PublicTimeline(settings.chat_timeline_size)
 templates = Jinja2Templates(directory="templates")
 
 
+@router.on_event("startup")
+async def start_message_writer():
+    if settings.chat_write_behind:
+        writer.start()
+
+
+@router.on_event("startup")
+async def create_message_partitions():
+    async with engine.begin() as connection:
+        await create_partitions(connection, settings.chat_partition_months_ahead)
+
+
+@router.on_event("startup")
+async def fill_public_timeline():
+    async with async_session_maker() as session:
+        await timeline.fill(session)
+
+
+@router.on_event("shutdown")
+async def stop_message_writer():
+    await writer.stop()
+
+
 @router.get("/")
 async def get(
         request: Request
@@ -35,59 +89,155 @@ async def get(
 
 @router.get("/all_users")
 async def get_all_chat_users():
-    users_list = [*manager.active_connections.keys()]
+    users_list = manager.online_users()
     return {'users_list': users_list}
 
 
-@router.get("/messages")
+@router.get("/messages", response_model=ChatHistory)
 async def get_all_chat_messages(
         session: Annotated[AsyncSession, Depends(get_async_session)],
         current_user: Annotated[UserInDB, Depends(get_chat_user_by_token)],
+        before: str | None = None,
+        after: str | None = None,
+        limit: int = Query(settings.chat_page_size, ge=1, le=settings.chat_max_page_size),
+):
+    if before and after:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before or after cursor",
+        )
+    before = decode_cursor(before) if before else None
+    public = timeline.page(limit, before) if not after else None
+    messages = await Message.get_chat(
+        session,
+        current_user.id,
+        limit=limit,
+        before=before,
+        after=decode_cursor(after) if after else None,
+        public=public is None,
+    )
+    if public is not None:
+        merged = heapq.merge(public, messages, key=lambda message: (message.posted, message.id))
+        messages = list(merged)[-limit:]
+    next_cursor = None
+    if len(messages) == limit:
+        edge = messages[-1] if after else messages[0]
+        next_cursor = encode_cursor(edge.posted, edge.id)
+    # Rows go straight to the encoder, ChatHistory only documents the shape
+    return Response(
+        content=dumps({'messages_list': [history_item(message) for message in messages], 'next_cursor': next_cursor}),
+        media_type='application/json',
+    )
+
+
+@router.get("/conversations", response_model=Conversations)
+async def get_conversations(
+        session: Annotated[AsyncSession, Depends(get_async_session)],
+        current_user: Annotated[UserInDB, Depends(get_chat_user_by_token)],
 ):
-    messages = await Message.get_chat(session, current_user.id)
-    return {'messages_list': messages}
+    private_rows, public_row = await Conversation.get_list(session, current_user.id)
+    conversations = [ConversationSummary(**row._asdict()) for row in private_rows]
+    if public_row is not None:
+        conversations.append(ConversationSummary(peer='all', **public_row._asdict()))
+    conversations.sort(key=lambda conversation: conversation.last_posted or datetime.min, reverse=True)
+    return {'conversations': conversations}
+
+
+@router.post("/conversations/read")
+async def mark_conversation_read(
+        session: Annotated[AsyncSession, Depends(get_async_session)],
+        current_user: Annotated[UserInDB, Depends(get_chat_user_by_token)],
+        peer: str = 'all',
+):
+    peer_id = None
+    if peer != 'all':
+        peer_user = await resolve_chat_user(peer)
+        if peer_user is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        peer_id = peer_user.id
+    await Conversation.mark_read(session, current_user.id, peer_id)
+    return {'peer': peer, 'unread_count': 0}
+
+
+def add_to_timeline(saved, sender: UserInDB):
+    if not saved.cancelled() and saved.exception() is None:
+        message = saved.result()
+        timeline.append(message.id, message.posted, sender.id, sender.username, message.text)
 
 
 @router.websocket("/ws")
 async def websocket_endpoint(
         websocket: WebSocket,
-        session: Annotated[AsyncSession, Depends(get_async_session)],
         current_user: Annotated[UserInDB, Depends(get_chat_user_by_token)],
+        last_seen_id: int | None = None,
+        encoding: str | None = None,
 ):
-    await manager.connect(websocket, current_user.username)
+    connection = await manager.connect(websocket, current_user.username, current_user.id, last_seen_id, encoding)
     try:
         while True:
-            message = ReceiveMessage.parse_obj(await websocket.receive_json())
+            try:
+                message = ReceiveMessage.parse_obj(await connection.receive())
+            except (ValidationError, ValueError, KeyError):
+                # Not JSON, not msgpack, the wrong frame type or the wrong shape
+                connection.put(Frame({'type': 'error', 'detail': 'Invalid message'}))
+                continue
+            kind = 'public' if message.receiver == 'all' else 'private'
+            throttled = limiter.check(connection.buckets, current_user.id, kind)
+            if throttled is not None:
+                scope, retry_after = throttled
+                chat_throttled_messages.labels(kind, scope).inc()
+                connection.put(Frame({
+                    'type': 'throttled',
+                    'kind': kind,
+                    'scope': scope,
+                    'retry_after': round(retry_after, 3),
+                }))
+                continue
             receiver = None
-            if message.receiver == 'all':
-                message_obj = SendMessage(
-                    receiver="all",
-                    text=message.text,
-                    sender=current_user.username
-                )
-                await manager.broadcast(message_obj)
-                await manager.send_personal_message(message_obj)
+            if message.receiver != 'all':
+                receiver = await resolve_chat_user(message.receiver)
+                if receiver is None:
+                    connection.put(Frame({'type': 'error', 'detail': f"Unknown receiver {message.receiver}"}))
+                    continue
+            message_id = None
+            if settings.chat_write_behind:
+                saved = writer.submit(text=message.text, sender=current_user, receiver=receiver)
+                if receiver is None:
+                    saved.add_done_callback(partial(add_to_timeline, sender=current_user))
+                if settings.chat_durable_ack:
+                    message_id = (await saved).id
             else:
-
-                receiver = await User.get_by_username(session, message.receiver)
-                message_obj = SendMessage(
-                    receiver=message.receiver,
-                    text=message.text,
-                    sender=current_user.username
-                )
-                await manager.send_personal_message(message_obj)
-
-            await Message.create(
-                session=session,
+                async with async_session_maker() as session:
+                    saved = await Message.create(
+                        session=session,
+                        text=message.text,
+                        sender=current_user,
+                        receiver=receiver)
+                message_id = saved.id
+                if receiver is None:
+                    timeline.append(saved.id, saved.posted, current_user.id, current_user.username, saved.text)
+
+            message_obj = SendMessage(
+                id=message_id,
+                receiver=message.receiver,
                 text=message.text,
-                sender=current_user,
-                receiver=receiver)
+                sender=current_user.username
+            )
+
+            if receiver is None:
+                chat_public_messages.inc()
+                manager.broadcast(message_obj, current_user.id)
+            else:
+                chat_private_messages.inc()
+            manager.send_personal_message(message_obj, current_user.id, receiver.id if receiver else None)
 
     except WebSocketDisconnect:
-        manager.disconnect(current_user.username)
-        message_dict = SendMessage(
-            receiver="all",
-            text='left the chat',
-            sender=current_user.username
-        )
-        await manager.broadcast(message_dict)
+        pass
+    finally:
+        if manager.disconnect(connection):
+            message_dict = SendMessage(
+                receiver="all",
+                text='left the chat',
+                sender=current_user.username
+            )
+            manager.broadcast(message_dict, current_user.id)
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+from auth import schema as user_schema
+from chat.models import Message
+from database import async_session_maker
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Write-behind buffer that persists chat messages in batched multi-row INSERTs."""
+
+    def __init__(self, batch_size: int, interval_ms: int):
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def submit(
+            self,
+            text: str,
+            sender: user_schema.UserInDB,
+            receiver: user_schema.UserInDB | None,
+    ) -> asyncio.Future:
+        row = {
+            'text': text,
+            'sender_id': sender.id,
+            'receiver_id': receiver.id if receiver else None,
+        }
+        saved = asyncio.get_running_loop().create_future()
+        self._pending.append((row, saved))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return saved
+
+    async def _run(self):
+        while self._running:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        # One flush at a time keeps batches, ids and `posted` in submit order,
+        # `posted` is stamped by the database and comes back through RETURNING
+        async with self._lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                try:
+                    async with async_session_maker() as session:
+                        messages = await Message.create_many(session, [row for row, _ in batch])
+                except Exception as err:
+                    logger.exception("Failed to persist %s chat messages", len(batch))
+                    for _, saved in batch:
+                        saved.set_exception(err)
+                        # Logged above, without a durable ack nobody awaits the future
+                        saved.exception()
+                else:
+                    for (_, saved), message in zip(batch, messages):
+                        saved.set_result(message)
@@ -1,3 +1,6 @@
+import os
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -6,6 +9,40 @@ class Settings(BaseSettings):
     algorithm: str
     access_token_expire_minutes: int
     upload_file_path: str = 'upload_files/'
+    avatar_sizes: list[int] = [32, 64, 256]
+    avatar_workers: int = 2
+    password_hash_executor: Literal['thread', 'process'] = 'thread'
+    password_hash_workers: int = 4
+    password_hash_queue_size: int = 64
+    bulk_import_token: str | None = None
+    bulk_import_batch_size: int = 500
+    bulk_import_workers: int = os.cpu_count() or 1
+    internal_token: str | None = None
+    user_cache_size: int = 10000
+    user_cache_ttl: int = 60
+    username_cache_size: int = 10000
+    username_cache_ttl: int = 300
+    username_cache_negative_ttl: int = 5
+    user_search_limit: int = 20
+    user_search_max_limit: int = 100
+    chat_page_size: int = 50
+    chat_max_page_size: int = 200
+    chat_send_queue_size: int = 256
+    chat_overflow_policy: Literal['drop_oldest', 'disconnect'] = 'drop_oldest'
+    chat_write_behind: bool = False
+    chat_flush_size: int = 100
+    chat_flush_interval_ms: int = 50
+    chat_durable_ack: bool = False
+    chat_public_rate: float = 1
+    chat_public_burst: int = 5
+    chat_private_rate: float = 3
+    chat_private_burst: int = 10
+    chat_user_rate_factor: float = 2
+    chat_timeline_size: int = 0
+    chat_public_counter_shards: int = 16
+    chat_partition_months_ahead: int = 3
+    chat_archive_after_months: int = 12
+    chat_archive_path: str = 'archive/'
     model_config = SettingsConfigDict(env_file=".env")
     db_engine: str
     db_host: str
@@ -13,6 +50,14 @@ class Settings(BaseSettings):
     db_name: str
     db_user: str
     db_pass: str
+    db_url: str | None = None
+    db_echo: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = False
+    db_statement_cache_size: int = 100
 
 
 settings = Settings()
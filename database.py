@@ -14,19 +14,63 @@
 # SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 #
 # Base = declarative_base()
+import time
 from typing import AsyncGenerator
 
+from sqlalchemy import DateTime, func
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from config import settings
+from metrics import instrument_engine, registry
 
 
-DATABASE_URL = f"{settings.db_engine}://{settings.db_user}:{settings.db_pass}@{settings.db_host}:{settings.db_port}/{settings.db_name}"
+DATABASE_URL = settings.db_url or \
+    f"{settings.db_engine}://{settings.db_user}:{settings.db_pass}@{settings.db_host}:{settings.db_port}/{settings.db_name}"
 
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that also records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            self.wait_count += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+
+def get_connect_args() -> dict:
+    if DATABASE_URL.startswith('postgresql+asyncpg'):
+        return {'prepared_statement_cache_size': settings.db_statement_cache_size}
+    return {}
+
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=settings.db_echo,
+    poolclass=InstrumentedPool,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=settings.db_pool_pre_ping,
+    connect_args=get_connect_args(),
+)
+instrument_engine(engine.sync_engine)
 Base = declarative_base()
 async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
@@ -34,3 +78,54 @@ async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
         yield session
+
+
+def dialect_insert(session: AsyncSession, table):
+    """INSERT with the ON CONFLICT support of the dialect in use."""
+    from sqlalchemy.dialects import postgresql, sqlite
+
+    dialect = postgresql if session.bind.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(table)
+
+
+class db_now(FunctionElement):
+    """The database's now(), on SQLite in the format datetimes are bound in.
+
+    SQLite's CURRENT_TIMESTAMP has no fraction of a second, so the stored text
+    would not compare in order with a datetime bound as a keyset cursor.
+    """
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(db_now)
+def compile_db_now(element, compiler, **kw):
+    return compiler.process(func.now(), **kw)
+
+
+@compiles(db_now, 'sqlite')
+def compile_db_now_sqlite(element, compiler, **kw):
+    # %f is seconds with milliseconds, padded to the microseconds SQLAlchemy writes
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+def get_pool_status() -> dict:
+    pool = engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'wait_count': getattr(pool, 'wait_count', 0),
+        'wait_time_total': getattr(pool, 'wait_time_total', 0.0),
+        'wait_time_max': getattr(pool, 'wait_time_max', 0.0),
+    }
+
+
+registry.gauge_callback('db_pool_checked_out', 'Connections checked out of the pool.', lambda: engine.pool.checkedout())
+registry.gauge_callback('db_pool_checked_in', 'Idle connections in the pool.', lambda: engine.pool.checkedin())
+registry.gauge_callback('db_pool_overflow', 'Overflow connections in use.', lambda: engine.pool.overflow())
+registry.counter_callback(
+    'db_pool_wait_seconds_total', 'Time spent waiting for a pooled connection.',
+    lambda: get_pool_status()['wait_time_total'],
+)
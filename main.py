@@ -1,8 +1,16 @@
-from fastapi import FastAPI
+import secrets
+from typing import Annotated
+
+from fastapi import FastAPI, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from auth.views import router as auth_router
+from auth.utils import AVATAR_MAX_BODY_SIZE, BodySizeLimitMiddleware
 from chat.views import router as chat_router
+from config import settings
+from database import get_pool_status
+from metrics import MetricsMiddleware, registry
 
 
 app = FastAPI(title="ITworkin", docs_url="/")
@@ -21,3 +29,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(BodySizeLimitMiddleware, limits={'/auth/user/avatar': AVATAR_MAX_BODY_SIZE})
+app.add_middleware(MetricsMiddleware)
+
+
+@app.get("/internal/db_pool", include_in_schema=False)
+async def db_pool_status(
+        x_internal_token: Annotated[str | None, Header()] = None,
+):
+    if settings.internal_token is None or not secrets.compare_digest(
+            x_internal_token or '', settings.internal_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed")
+    return get_pool_status()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,202 @@
+import time
+from bisect import bisect_left
+from typing import Callable
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ('labels', 'value')
+
+    def __init__(self, labels: dict[str, str]):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self, name: str):
+        yield name, self.labels, self.value
+
+
+class Histogram:
+    """Fixed-bucket histogram, observe() only bumps preallocated slots."""
+    __slots__ = ('labels', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, labels: dict[str, str], buckets: tuple[float, ...]):
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket', {**self.labels, 'le': repr(bound)}, cumulative
+        yield f'{name}_bucket', {**self.labels, 'le': '+Inf'}, self.count
+        yield f'{name}_sum', self.labels, self.sum
+        yield f'{name}_count', self.labels, self.count
+
+
+class Metric:
+    """A named metric family, children are created once per label set."""
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            metric_type: str,
+            label_names: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.label_names = label_names
+        self.buckets = buckets
+        self.children: dict[tuple[str, ...], Counter | Histogram] = {}
+
+    def labels(self, *values: str) -> Counter | Histogram:
+        child = self.children.get(values)
+        if child is None:
+            labels = dict(zip(self.label_names, values))
+            if self.type == 'histogram':
+                child = Histogram(labels, self.buckets)
+            else:
+                child = Counter(labels)
+            self.children[values] = child
+        return child
+
+    def samples(self):
+        for child in list(self.children.values()):
+            yield from child.samples(self.name)
+
+
+class CallbackMetric:
+    """Gauge or counter whose value is read from the owning object at scrape time."""
+
+    def __init__(self, name: str, documentation: str, metric_type: str, callback: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.callback = callback
+
+    def samples(self):
+        yield self.name, {}, self.callback()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric | CallbackMetric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Metric:
+        return self.register(Metric(name, documentation, 'counter', label_names))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            label_names: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Metric:
+        return self.register(Metric(name, documentation, 'histogram', label_names, buckets))
+
+    def gauge_callback(self, name: str, documentation: str, callback: Callable[[], float]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, 'gauge', callback))
+
+    def counter_callback(self, name: str, documentation: str, callback: Callable[[], float]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, 'counter', callback))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route.', ('method', 'route'),
+)
+chat_broadcast_duration = registry.histogram(
+    'chat_broadcast_duration_seconds', 'Time spent fanning a message out to connection queues.',
+).labels()
+chat_messages = registry.counter('chat_messages_total', 'Chat messages received.', ('kind',))
+chat_public_messages = chat_messages.labels('public')
+chat_private_messages = chat_messages.labels('private')
+chat_throttled_messages = registry.counter(
+    'chat_throttled_messages_total', 'Chat messages rejected by the rate limiter.', ('kind', 'scope'),
+)
+db_statement_duration = registry.histogram(
+    'db_statement_duration_seconds', 'Database statement execution time.', ('statement',),
+)
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get('route')
+            http_request_duration.labels(
+                scope['method'], route.path if route is not None else 'unmatched',
+            ).observe(time.perf_counter() - started)
+
+
+def instrument_engine(sync_engine):
+    from sqlalchemy import event
+
+    statements = {
+        kind: db_statement_duration.labels(kind) for kind in ('select', 'insert', 'update', 'delete')
+    }
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context.isinsert:
+            histogram = statements['insert']
+        elif context.isupdate:
+            histogram = statements['update']
+        elif context.isdelete:
+            histogram = statements['delete']
+        else:
+            histogram = statements['select']
+        histogram.observe(time.perf_counter() - context.metrics_started)
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+import uvicorn
+from sqlalchemy import text
+
+# Settings are read on import, so the database is chosen before any app module is loaded.
+# TEST_DB_URL runs the suite against PostgreSQL, otherwise it uses a throwaway SQLite file.
+tmp_dir = tempfile.TemporaryDirectory()
+os.environ['DB_URL'] = os.environ.get('TEST_DB_URL') or f"sqlite+aiosqlite:///{os.path.join(tmp_dir.name, 'test.db')}"
+os.environ.setdefault('DB_ECHO', 'false')
+# A small pool with no overflow, tests that need more connections than this fail on the pool timeout
+os.environ.setdefault('DB_POOL_SIZE', '5')
+os.environ.setdefault('DB_MAX_OVERFLOW', '0')
+os.environ.setdefault('DB_POOL_TIMEOUT', '10')
+
+# Imported for their side effects: the models register on Base.metadata for create_all,
+# and auth.models has to load before auth.utils to avoid a circular import
+from auth.models import User  # noqa: E402, F401
+from auth.utils import user_cache, username_cache  # noqa: E402
+from chat.models import Message  # noqa: E402, F401, registers the chat tables, see above
+from database import Base, engine  # noqa: E402
+
+
+def pytest_collection_modifyitems(config, items):
+    if engine.dialect.name == 'postgresql':
+        return
+    skip = pytest.mark.skip(reason='needs TEST_DB_URL pointing at PostgreSQL')
+    for item in items:
+        if 'postgres' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+async def database():
+    async with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            await connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+    # Ids and usernames start over with the schema, cached users from another test would be wrong
+    user_cache.clear()
+    username_cache.clear()
+    yield engine
+    await engine.dispose()
+
+
+class ChatServer(uvicorn.Server):
+    def install_signal_handlers(self):
+        # pytest keeps its own handlers
+        pass
+
+
+@pytest.fixture
+async def chat_server(database):
+    """The app served by uvicorn on this test's event loop, yields the chat WebSocket URL."""
+    from main import app
+
+    server = ChatServer(uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    yield f"ws://127.0.0.1:{server.servers[0].sockets[0].getsockname()[1]}/chat/ws"
+    server.should_exit = True
+    await task
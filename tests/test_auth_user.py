@@ -0,0 +1,24 @@
+import httpx
+import pytest
+
+from auth.models import User
+from auth.utils import create_access_token
+from database import async_session_maker
+from main import app
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_get_user_without_avatar(database):
+    async with async_session_maker() as session:
+        user = User(username='newcomer', hash_password='x')
+        session.add(user)
+        await session.commit()
+    headers = {'Authorization': f"Bearer {create_access_token({'sub': str(user.id)})}"}
+
+    async with httpx.AsyncClient(app=app, base_url='http://testserver') as client:
+        for params in ({}, {'avatar_size': 64}):
+            response = await client.get('/auth/user', params=params, headers=headers)
+            assert response.status_code == 200
+            assert response.json()['avatar_link'] is None
+            assert response.json()['avatar_variants'] is None
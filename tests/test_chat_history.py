@@ -0,0 +1,41 @@
+import httpx
+import pytest
+
+from auth.models import User
+from auth.utils import create_access_token
+from chat.models import Message
+from database import async_session_maker
+from main import app
+
+pytestmark = pytest.mark.anyio
+
+MESSAGES = 25
+PAGE = 10
+
+
+async def test_before_cursor_pages_back(database):
+    async with async_session_maker() as session:
+        user = User(username='reader', hash_password='x')
+        session.add(user)
+        await session.commit()
+        # One batch, every row gets the same second and only the id tells them apart
+        await Message.create_many(session, [
+            {'text': f'hi {index}', 'sender_id': user.id, 'receiver_id': None} for index in range(MESSAGES)
+        ])
+    token = create_access_token({'sub': str(user.id)})
+
+    pages = []
+    params = {'token': token, 'limit': PAGE}
+    async with httpx.AsyncClient(app=app, base_url='http://testserver') as client:
+        while True:
+            response = await client.get('/chat/messages', params=params)
+            assert response.status_code == 200
+            pages.append([message['text'] for message in response.json()['messages_list']])
+            cursor = response.json()['next_cursor']
+            if cursor is None or len(pages) > MESSAGES // PAGE + 1:
+                break
+            params = {'token': token, 'limit': PAGE, 'before': cursor}
+
+    assert [len(page) for page in pages] == [10, 10, 5]
+    texts = [text for page in reversed(pages) for text in page]
+    assert texts == [f'hi {index}' for index in range(MESSAGES)]
@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+import websockets
+
+from auth.models import User
+from auth.utils import create_access_token
+from chat import views
+from chat.ratelimit import RateLimiter
+from database import async_session_maker
+
+pytestmark = pytest.mark.anyio
+
+# Next to no refill, so only bursts count and the test does not depend on timing
+BURST = 3
+
+
+async def send(socket, text: str) -> dict:
+    """Send a public message, returns the sender's own copy or the throttled frame."""
+    await socket.send(json.dumps({'receiver': 'all', 'text': text}))
+    async with asyncio.timeout(10):
+        while True:
+            frame = json.loads(await socket.recv())
+            if frame.get('type') == 'throttled' or frame.get('text') == text:
+                return frame
+
+
+async def test_flooder_is_throttled_without_starving_others(chat_server, monkeypatch):
+    monkeypatch.setattr(views, 'limiter', RateLimiter(
+        limits={'public': (0.001, BURST), 'private': (0.001, BURST)},
+        user_factor=2,
+    ))
+    async with async_session_maker() as session:
+        flooder, *others = users = [User(username=f'user{index}', hash_password='x') for index in range(4)]
+        session.add_all(users)
+        await session.commit()
+    tokens = {user.id: create_access_token({'sub': str(user.id)}) for user in users}
+
+    def connect(user):
+        return websockets.connect(f'{chat_server}?token={tokens[user.id]}')
+
+    sockets = [await connect(user) for user in others]
+    first = await connect(flooder)
+    flood = [await send(first, f'flood {index}') for index in range(10)]
+    assert [frame.get('scope') for frame in flood] == [None] * BURST + ['connection'] * (10 - BURST)
+
+    for index, socket in enumerate(sockets):
+        for round_ in range(2):
+            frame = await send(socket, f'normal {index} {round_}')
+            assert 'type' not in frame
+
+    # A second connection brings its own bucket, but together they drain the user bucket
+    second = await connect(flooder)
+    flood = [await send(second, f'again {index}') for index in range(BURST)]
+    assert [frame.get('scope') for frame in flood] == [None] * BURST
+
+    base_url = chat_server.replace('ws://', 'http://').removesuffix('/chat/ws')
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        response = await client.put(
+            '/auth/user', params={'username': 'renamed'}, headers={'Authorization': f'Bearer {tokens[flooder.id]}'})
+        assert response.status_code == 200
+    third = await connect(flooder)
+    assert (await send(third, 'after rename')).get('scope') == 'user'
+
+    for socket in (*sockets, first, second, third):
+        await socket.close()
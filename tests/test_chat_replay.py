@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from auth.models import User
+from auth.utils import create_access_token
+from chat.models import Message
+from database import async_session_maker
+
+pytestmark = pytest.mark.anyio
+
+
+def connect(chat_server: str, user: User, **params):
+    query = ''.join(f'&{name}={value}' for name, value in params.items())
+    return websockets.connect(f"{chat_server}?token={create_access_token({'sub': str(user.id)})}{query}")
+
+
+async def receive(socket) -> dict:
+    async with asyncio.timeout(10):
+        return json.loads(await socket.recv())
+
+
+async def test_presence_changes_during_replay_apply_on_top_of_the_snapshot(chat_server, monkeypatch):
+    async with async_session_maker() as session:
+        alice, bob, carol = users = [User(username=name, hash_password='x') for name in ('alice', 'bob', 'carol')]
+        session.add_all(users)
+        await session.commit()
+        session.add(Message(text='missed', sender_id=alice.id))
+        await session.commit()
+
+    replaying = asyncio.Event()
+    release = asyncio.Event()
+    get_since = Message.get_since.__func__
+
+    async def slow_get_since(cls, *args, **kwargs):
+        replaying.set()
+        await release.wait()
+        return await get_since(cls, *args, **kwargs)
+
+    monkeypatch.setattr(Message, 'get_since', classmethod(slow_get_since))
+
+    alice_socket = await connect(chat_server, alice)
+    await receive(alice_socket)
+    async with connect(chat_server, bob, last_seen_id=0) as bob_socket:
+        await replaying.wait()
+        # carol joins and alice leaves while bob is still replaying
+        carol_socket = await connect(chat_server, carol)
+        await alice_socket.close()
+        while 'left' not in await receive(carol_socket):
+            pass
+        release.set()
+
+        snapshot = await receive(bob_socket)
+        assert snapshot['type'] == 'presence' and set(snapshot['users']) == {'alice', 'bob'}
+        assert (await receive(bob_socket))['text'] == 'missed'
+        online = set(snapshot['users'])
+        for _ in range(2):
+            frame = await receive(bob_socket)
+            online.update(frame.get('joined', []))
+            online.difference_update(frame.get('left', []))
+        assert online == {'bob', 'carol'}
+        await carol_socket.close()
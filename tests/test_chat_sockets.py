@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+from sqlalchemy import func, select
+
+from auth.models import User
+from auth.utils import create_access_token
+from chat.models import Message
+from chat.views import manager
+from config import settings
+from database import async_session_maker, engine
+
+pytestmark = pytest.mark.anyio
+
+SOCKETS = 500
+HANDSHAKES = 50
+
+
+async def receive_message(socket, text: str, timeout: float = 60):
+    async with asyncio.timeout(timeout):
+        while True:
+            frame = json.loads(await socket.recv())
+            if frame.get('text') == text:
+                return frame
+
+
+async def test_sockets_outnumber_the_pool(chat_server):
+    assert (settings.db_pool_size, settings.db_max_overflow) == (5, 0)
+    async with async_session_maker() as session:
+        users = [User(username=f'user{index}', hash_password='x') for index in range(SOCKETS)]
+        session.add_all(users)
+        await session.commit()
+
+    # Handshakes are spread out a little, the sockets all end up open at the same time
+    handshakes = asyncio.Semaphore(HANDSHAKES)
+
+    async def connect(user):
+        async with handshakes:
+            return await websockets.connect(
+                f"{chat_server}?token={create_access_token({'sub': str(user.id)})}", max_queue=None,
+            )
+
+    sockets = await asyncio.gather(*[connect(user) for user in users])
+    try:
+        # Every socket stays open while none of them holds a pooled connection
+        assert manager.connection_count() == SOCKETS
+        assert engine.pool.checkedout() == 0
+
+        for index, socket in enumerate(sockets):
+            await socket.send(json.dumps({'receiver': f'user{(index + 1) % SOCKETS}', 'text': f'hi from {index}'}))
+        received = await asyncio.gather(*[
+            receive_message(socket, f'hi from {(index - 1) % SOCKETS}') for index, socket in enumerate(sockets)
+        ])
+        assert all(frame['receiver'] == f'user{index}' for index, frame in enumerate(received))
+    finally:
+        await asyncio.gather(*[socket.close() for socket in sockets])
+
+    async with async_session_maker() as session:
+        assert await session.scalar(select(func.count()).select_from(Message)) == SOCKETS
+    assert engine.pool.checkedout() == 0
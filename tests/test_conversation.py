@@ -0,0 +1,37 @@
+import pytest
+from sqlalchemy import func, select
+
+from auth.models import User
+from chat.models import Conversation, Message
+from config import settings
+from database import async_session_maker
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_public_count_spread_over_shards(database, monkeypatch):
+    monkeypatch.setattr(settings, 'chat_public_counter_shards', 4)
+    async with async_session_maker() as session:
+        sender, reader = User(username='sender', hash_password='x'), User(username='reader', hash_password='x')
+        session.add_all([sender, reader])
+        await session.commit()
+        await Conversation.catch_up_public(session, [sender.id, reader.id])
+        await session.commit()
+
+        for index in range(20):
+            await Message.create_many(session, [{'text': f'hi {index}', 'sender_id': sender.id, 'receiver_id': None}])
+        assert await session.scalar(select(func.count()).filter(Conversation.user_id.is_(None))) > 1
+        assert await Conversation.public_count(session) == 20
+
+        _, public = await Conversation.get_list(session, reader.id)
+        assert public.unread_count == 20
+        assert public.last_message_id == await session.scalar(select(func.max(Message.id)))
+        _, public = await Conversation.get_list(session, sender.id)
+        assert public.unread_count == 0
+
+        # A stale mark, e.g. from a slower concurrent writer, leaves the marker where it is
+        await Conversation.mark_read(session, reader.id, None)
+        await Conversation.mark_public_read(session, [reader.id], 5)
+        await session.commit()
+        _, public = await Conversation.get_list(session, reader.id)
+        assert public.unread_count == 0
@@ -0,0 +1,67 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, insert, text
+
+from auth.models import User
+from chat.models import Message
+from database import async_session_maker
+
+pytestmark = [pytest.mark.anyio, pytest.mark.postgres]
+
+USERS = 50
+# Enough history that an index beats scanning message on cost alone
+MESSAGES = 50000
+
+
+@contextmanager
+def captured(sync_engine):
+    """Collects the SQL and parameters of every statement sent to the database."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(sync_engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(sync_engine, 'before_cursor_execute', capture)
+
+
+async def test_history_queries_use_indexes(database):
+    async with async_session_maker() as session:
+        users = [User(username=f'user{index}', hash_password='x') for index in range(USERS)]
+        session.add_all(users)
+        await session.commit()
+        started = datetime.utcnow() - timedelta(seconds=MESSAGES)
+        await session.execute(insert(Message), [
+            {
+                'text': 'hello',
+                'sender_id': users[index % USERS].id,
+                'receiver_id': None if index % 2 else users[(index + 1) % USERS].id,
+                'posted': started + timedelta(seconds=index),
+            }
+            for index in range(MESSAGES)
+        ])
+        await session.commit()
+
+        await session.execute(text('ANALYZE message'))
+        user_id = users[0].id
+        cursor = (datetime.utcnow(), 10 ** 9)
+        queries = {
+            'latest page': lambda: Message.get_chat(session, user_id, limit=50),
+            'before cursor': lambda: Message.get_chat(session, user_id, limit=50, before=cursor),
+            'after cursor': lambda: Message.get_chat(session, user_id, limit=50, after=(datetime.min, 0)),
+            'private only': lambda: Message.get_chat(session, user_id, limit=50, public=False),
+            'replay': lambda: Message.get_since(session, user_id, 0, 50),
+        }
+        connection = await session.connection()
+        for name, query in queries.items():
+            with captured(database.sync_engine) as statements:
+                await query()
+            for statement, parameters in statements:
+                result = await connection.exec_driver_sql(f'EXPLAIN {statement}', parameters)
+                plan = '\n'.join(result.scalars().all())
+                assert 'Seq Scan on message' not in plan, f'{name} scans message:\n{plan}'
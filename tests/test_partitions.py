@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from chat.partitions import add_months, create_partitions, month_start, partition_name
+
+pytestmark = [pytest.mark.anyio, pytest.mark.postgres]
+
+
+async def test_create_moves_rows_out_of_default(database):
+    current = month_start(datetime.utcnow().date())
+    later = add_months(current, 2)
+    async with database.begin() as connection:
+        # The layout of the partitioning migration, with only the default partition so far
+        await connection.execute(text('DROP TABLE message'))
+        await connection.execute(text('''
+            CREATE TABLE message (
+                id SERIAL,
+                text VARCHAR,
+                sender_id INTEGER REFERENCES "user" (id),
+                receiver_id INTEGER REFERENCES "user" (id),
+                posted TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+                PRIMARY KEY (id, posted)
+            ) PARTITION BY RANGE (posted)
+        '''))
+        await connection.execute(text('CREATE TABLE message_default PARTITION OF message DEFAULT'))
+        await connection.execute(text(
+            f"INSERT INTO message (text, posted) VALUES ('now', now()), ('later', '{later}')"
+        ))
+
+    async with database.begin() as connection:
+        created = await create_partitions(connection, 3)
+        assert created == [partition_name(add_months(current, offset)) for offset in range(4)]
+        assert (await connection.execute(text('SELECT count(*) FROM message_default'))).scalar() == 0
+        located = await connection.execute(text('SELECT text, tableoid::regclass::text FROM message ORDER BY id'))
+        assert located.all() == [('now', partition_name(current)), ('later', partition_name(later))]
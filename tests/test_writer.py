@@ -0,0 +1,52 @@
+import asyncio
+import gc
+
+import pytest
+from sqlalchemy import select
+
+from auth.models import User
+from auth.schema import UserInDB
+from chat.models import Message
+from chat.writer import MessageWriter, logger
+from database import async_session_maker
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_database_stamps_posted(database):
+    async with async_session_maker() as session:
+        user = User(username='writer', hash_password='x')
+        session.add(user)
+        await session.commit()
+    sender = UserInDB.model_validate(user, from_attributes=True)
+
+    writer = MessageWriter(batch_size=10, interval_ms=1000)
+    saved = [writer.submit(f'hi {index}', sender, None) for index in range(3)]
+    await writer.flush()
+    messages = [future.result() for future in saved]
+
+    async with async_session_maker() as session:
+        stored = (await session.execute(select(Message.id, Message.posted).order_by(Message.id))).all()
+    assert [(message.id, message.posted) for message in messages] == [tuple(row) for row in stored]
+
+
+async def test_failed_flush_without_waiters(database, monkeypatch):
+    async def fail(session, rows):
+        raise RuntimeError('database is gone')
+
+    monkeypatch.setattr(Message, 'create_many', fail)
+    # Captured log records would keep the futures alive through the traceback
+    monkeypatch.setattr(logger, 'disabled', True)
+    unhandled = []
+    loop = asyncio.get_running_loop()
+    default_handler = loop.get_exception_handler()
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+    try:
+        writer = MessageWriter(batch_size=10, interval_ms=1000)
+        sender = UserInDB(id=1, username='writer', hash_password='x')
+        writer.submit('lost', sender, None)
+        await writer.flush()
+        gc.collect()
+    finally:
+        loop.set_exception_handler(default_handler)
+    assert unhandled == []